@@ -1,14 +1,46 @@
 import datetime
+import functools
+import time
 
+# The countdown strings, by minute. Arrivals an hour or more away show their clock time instead
+_MINUTE_STRINGS = tuple(str(minutes) + "min" for minutes in range(60))
+
+
+@functools.total_ordering
 class ArrivalTime:
-    """ Represents the arrival times of buses at one of the configured stops """
+    """
+    Represents the arrival times of buses at one of the configured stops.
+    Arrivals never change once created, and are ordered by arrival time, then route, then stop.
+    """
+    __slots__ = ("stop_id", "route_id", "destination", "is_added", "arrival_epoch", "_arrival_monotonic", "_key",
+                 "_clock_str")
+
+    def __init__(self, stop_id: str, route_id: str, destination: str, arrival_epoch: float, is_added: bool = False) -> None:
+        """ arrival_epoch is the predicted arrival as a Unix timestamp """
+        set_field = functools.partial(object.__setattr__, self)
+        set_field("stop_id", stop_id)
+        set_field("route_id", route_id)
+        set_field("destination", destination)
+        set_field("is_added", is_added)
+        set_field("arrival_epoch", arrival_epoch)
+        # The monotonic clock is used for the countdown because the wall clock can jump (e.g. when NTP syncs)
+        set_field("_arrival_monotonic", time.monotonic() + arrival_epoch - time.time())
+        set_field("_key", (arrival_epoch, route_id or "", stop_id or "", destination or "", is_added))
+        # Formatted the first time it's shown
+        set_field("_clock_str", None)
+
+    def __setattr__(self, name, value) -> None:
+        raise AttributeError("ArrivalTime is immutable")
 
-    def __init__(self, stop_id: str, route_id: str, destination: str, due_in_seconds: int, is_added: bool = False) -> None:
-        self.stop_id = stop_id
-        self.route_id = route_id
-        self.destination = destination
-        self.due_in_seconds = due_in_seconds
-        self.is_added = is_added
+    def __delattr__(self, name) -> None:
+        raise AttributeError("ArrivalTime is immutable")
+
+    def __reduce__(self):
+        return (ArrivalTime, (self.stop_id, self.route_id, self.destination, self.arrival_epoch, self.is_added))
+
+    @property
+    def due_in_seconds(self) -> int:
+        return int(self._arrival_monotonic - time.monotonic())
 
     @property
     def due_in_minutes(self) -> int:
@@ -17,12 +49,49 @@ class ArrivalTime:
     def is_due(self) ->  bool:
         return self.due_in_minutes < 1
 
+    def has_departed(self) -> bool:
+        return time.monotonic() > self._arrival_monotonic
+
     def due_in_str(self) -> str:
-        if self.due_in_minutes < 60:
-            return str(self.due_in_minutes) + "min"
-        else:
-            due_in = datetime.datetime.now() + datetime.timedelta(0, self.due_in_seconds)
-            return due_in.strftime("%H:%M")
-
-    def __lt__(self, other) -> int:
-        return self.due_in_seconds < other.due_in_seconds
\ No newline at end of file
+        due_in_minutes = self.due_in_minutes
+        if due_in_minutes < 60:
+            return _MINUTE_STRINGS[max(0, due_in_minutes)]
+        if self._clock_str is None:
+            object.__setattr__(self, "_clock_str", datetime.datetime.fromtimestamp(self.arrival_epoch).strftime("%H:%M"))
+        return self._clock_str
+
+    def __lt__(self, other) -> bool:
+        if not isinstance(other, ArrivalTime):
+            return NotImplemented
+        return self._key < other._key
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, ArrivalTime):
+            return NotImplemented
+        return self._key == other._key
+
+    def __hash__(self) -> int:
+        return hash(self._key)
+
+    def __repr__(self) -> str:
+        return "ArrivalTime({!r}, {!r}, {!r}, {}{})".format(self.stop_id, self.route_id, self.destination,
+                                                            self.arrival_epoch, ", added" if self.is_added else "")
+
+    def to_dict(self) -> dict:
+        """ Returns this arrival as a dictionary that can be encoded as JSON """
+        return {
+            "stop_id": self.stop_id,
+            "route_id": self.route_id,
+            "destination": self.destination,
+            "arrival_epoch": self.arrival_epoch,
+            "is_added": self.is_added
+        }
+
+    @staticmethod
+    def from_dict(d: dict) -> "ArrivalTime":
+        """ Rebuilds an arrival from the output of to_dict() """
+        return ArrivalTime(stop_id = d["stop_id"],
+                           route_id = d["route_id"],
+                           destination = d["destination"],
+                           arrival_epoch = d["arrival_epoch"],
+                           is_added = d.get("is_added", False))
@@ -0,0 +1,71 @@
+# Last known arrival times, kept on disk
+# Loading the timetable takes a while on a Pi Zero, so the latest arrivals, GTFS-R deltas and cancellations
+# are saved to a small file. After a restart, the display shows them right away, with the countdowns
+# moved on by the time that passed, while the timetable loads in the background.
+# This module is imported before the timetable, so it must not import pandas or the GTFS client.
+
+from arrival_times import ArrivalTime
+import atomic_file
+import json
+import sys
+import time
+
+SNAPSHOT_VERSION = 1
+
+
+class Snapshot:
+    """ The contents of a snapshot file """
+
+    def __init__(self, saved_at: float, arrivals: list[ArrivalTime], deltas: dict, canceled_trips: set,
+                 added_stops: list[ArrivalTime]) -> None:
+        self.saved_at = saved_at
+        self.arrivals = arrivals
+        self.deltas = deltas
+        self.canceled_trips = canceled_trips
+        self.added_stops = added_stops
+
+    @property
+    def age_seconds(self) -> float:
+        return time.time() - self.saved_at
+
+
+def save(path: str, arrivals: list[ArrivalTime], deltas: dict, canceled_trips: set, added_stops: list[ArrivalTime]) -> None:
+    """
+    Write a snapshot. It is written under a temporary name, flushed to disk and renamed,
+    so a power cut never leaves a half-written snapshot behind.
+    """
+    snapshot = {
+        "version": SNAPSHOT_VERSION,
+        "saved_at": time.time(),
+        "arrivals": [arrival.to_dict() for arrival in arrivals],
+        "deltas": deltas,
+        "canceled_trips": sorted(canceled_trips),
+        "added_stops": [arrival.to_dict() for arrival in added_stops],
+    }
+    try:
+        with atomic_file.replace_file(path, fsync=True) as f:
+            json.dump(snapshot, f)
+    except Exception as e:
+        print("Could not save the arrivals snapshot {}: {}".format(path, str(e)), file=sys.stderr)
+
+
+def load(path: str) -> Snapshot:
+    """ Read a snapshot, leaving out the buses that already left. Returns None if there's no valid snapshot """
+    try:
+        with open(path) as f:
+            snapshot = json.load(f)
+        if snapshot.get("version") != SNAPSHOT_VERSION:
+            return None
+
+        arrivals = [ArrivalTime.from_dict(d) for d in snapshot["arrivals"]]
+        added_stops = [ArrivalTime.from_dict(d) for d in snapshot["added_stops"]]
+        return Snapshot(saved_at=snapshot["saved_at"],
+                        arrivals=[arrival for arrival in arrivals if not arrival.has_departed()],
+                        deltas=snapshot["deltas"],
+                        canceled_trips=set(snapshot["canceled_trips"]),
+                        added_stops=[arrival for arrival in added_stops if not arrival.has_departed()])
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print("Could not read the arrivals snapshot {}: {}".format(path, str(e)), file=sys.stderr)
+        return None
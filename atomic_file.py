@@ -0,0 +1,34 @@
+# Files that are replaced as a whole
+# The timetable index, the feed metadata, the metrics file and the arrivals snapshot are rewritten while
+# the program runs. Each one is written under a unique temporary name in its own directory and then renamed
+# over the old file, so readers never see half a file, and two processes writing the same file never
+# write to the same temporary file.
+
+import contextlib
+import os
+import tempfile
+
+
+@contextlib.contextmanager
+def replace_file(path: str, mode: str = "w", permissions: int = 0o644, fsync: bool = False):
+    """
+    Opens a temporary file for writing ("w" or "wb"), which replaces the file at path when the with block ends.
+    If the block raises, the file at path is left as it was and the temporary file is removed.
+    The new file gets the given permissions. With fsync, it is flushed to disk before the rename,
+    for the files that must survive a power cut.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + ".",
+                                    suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode) as f:
+            # mkstemp creates files that only we can read
+            os.fchmod(f.fileno(), permissions)
+            yield f
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+# Performance benchmarks
+# Generates a synthetic GTFS feed and GTFS-R TripUpdates payloads, serves them from a local HTTP server
+# and measures how long the display takes to load the feed, refresh the arrival times and parse the deltas.
+# Everything runs offline. The results are written as JSON, so they can be compared across commits:
+#
+#   $ python3 benchmarks/bench.py --output results.json
+#   $ python3 benchmarks/bench.py --stops 5000 --trips-per-route 400 --entities 5000
+#
+# It also checks that the timetable engines (pandas and lite) give the same departures, and exits
+# with an error if they don't.
+
+import argparse
+import datetime
+import importlib
+import functools
+import http.server
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import synthetic_feed
+import timetable_index
+
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_directory(directory: str) -> http.server.ThreadingHTTPServer:
+    """ Serves the files in the directory on a free local port, from a background thread """
+    handler = functools.partial(_QuietHandler, directory=directory)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, name="bench-http", daemon=True).start()
+    return server
+
+
+def summarize(samples: list[float]) -> dict:
+    """ Summary statistics of a list of durations in seconds """
+    samples = sorted(samples)
+    return {
+        "count": len(samples),
+        "min_s": samples[0],
+        "median_s": statistics.median(samples),
+        "p95_s": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        "max_s": samples[-1],
+    }
+
+
+def peak_rss_kb() -> int:
+    """ Peak resident set size of this process, in KB """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux reports KB
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+def _run_client(feed_url: str, gtfs_r_url: str, stop_codes: list[str], refreshes: int, workers: int, engine: str,
+                results: multiprocessing.Queue) -> None:
+    """
+    Runs in a fresh process, so that every measurement of the feed load starts from the same state
+    and the peak RSS belongs to one GTFSClient only.
+    """
+    # Keep the app's own output away from the results
+    sys.stdout = sys.stderr
+    from gtfs_client import GTFSClient
+    from poll_scheduler import PollScheduler
+
+    update_queue = queue.Queue()
+    started = time.perf_counter()
+    client = GTFSClient(feed_url, gtfs_r_url, "benchmark", stop_codes, {}, update_queue, 60, feed_load_workers=workers,
+                        timetable_engine=engine)
+    load_seconds = time.perf_counter() - started
+    load_rss_kb = peak_rss_kb()
+    # Poll GTFS-R on every refresh, so that each one is timed in full
+    client.poll_scheduler = PollScheduler(0, 0)
+
+    refresh_samples = []
+    for _ in range(refreshes):
+        started = time.perf_counter()
+        client.refresh()
+        refresh_samples.append(time.perf_counter() - started)
+        update_queue.get_nowait()
+
+    next_buses_samples = []
+    for _ in range(refreshes * 10):
+        started = time.perf_counter()
+        client.get_next_n_buses(10)
+        next_buses_samples.append(time.perf_counter() - started)
+
+    results.put({
+        "load_s": load_seconds,
+        "load_peak_rss_kb": load_rss_kb,
+        "peak_rss_kb": peak_rss_kb(),
+        "refresh": summarize(refresh_samples),
+        "next_buses": summarize(next_buses_samples),
+        "deltas": sum(len(d) for d in client.deltas.values()),
+        "canceled_trips": len(client.canceled_trips),
+        "added_stops": len(client.added_stops),
+        "pandas_imported": "pandas" in sys.modules,
+    })
+
+
+def run_client(*args) -> dict:
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=_run_client, args=args + (results,))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def bench_parse(payloads: dict[str, bytes], relevant_trip_ids: frozenset, repeat: int) -> dict:
+    """ Throughput of the GTFS-R parsers over payloads held in memory, with the same prefilter as GTFSClient """
+    import gtfs_realtime
+    import io
+
+    wants_trip = lambda trip: trip.get("trip_id") in relevant_trip_ids
+    results = {}
+    for encoding, payload in payloads.items():
+        samples = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            if encoding == "protobuf":
+                chunks = (payload[i:i + 65536] for i in range(0, len(payload), 65536))
+                entities = list(gtfs_realtime.iter_trip_updates_protobuf(chunks, wants_trip))
+            else:
+                entities = list(gtfs_realtime.iter_trip_updates_json(io.BytesIO(payload), wants_trip))
+            samples.append(time.perf_counter() - started)
+
+        best = min(samples)
+        results[encoding] = {
+            "payload_bytes": len(payload),
+            "kept_entities": len(entities),
+            "time": summarize(samples),
+            "mb_per_s": len(payload) / best / 1e6,
+        }
+    return results
+
+
+# Modules that must not be imported before the splash screen is drawn
+HEAVY_MODULES = ["pandas", "gtfs_kit", "timetable", "gtfs_client"]
+
+
+def bench_startup(repeat: int) -> dict:
+    """
+    Time taken to import main.py and screen.py (which main() imports first), which is what stands between starting
+    the program and the splash screen, and which of the heavy modules they import. Measured with python -X importtime
+    in a fresh interpreter every time.
+    """
+    code = ("import sys; sys.path.insert(0, {!r}); import main, screen; "
+            "print(' '.join(m for m in {!r} if m in sys.modules))").format(REPO_DIR, HEAVY_MODULES)
+    samples = []
+    for _ in range(repeat):
+        process = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True,
+                                 check=True, env=dict(os.environ, PYGAME_HIDE_SUPPORT_PROMPT="1"))
+        # The lines look like "import time:  self [us] | cumulative | module", the cumulative times of main
+        # and screen add up to the total
+        total = 0
+        for line in process.stderr.splitlines():
+            fields = line.split("|")
+            if len(fields) == 3 and fields[2].strip() in ("main", "screen"):
+                total += int(fields[1])
+        samples.append(total / 1e6)
+        heavy_modules = process.stdout.split()
+
+    return {
+        "import_main": summarize(samples),
+        "heavy_modules_imported": heavy_modules,
+    }
+
+
+def check_engines(path: str, feed: synthetic_feed.SyntheticFeed, stop_codes: list[str]) -> dict:
+    """
+    Differential check of the timetable engines. The feed is loaded with each engine, and their lookups
+    and the departures they return every few minutes over three days are compared, for all the stops,
+    for each stop alone and with routes_for_stops. Departures are compared as the fields of the ArrivalTime
+    they turn into.
+    """
+    import gtfs_client
+
+    # Show only one of the routes at the first stop
+    first_stop_id = "S{}".format(int(stop_codes[0]) - 1000)
+    routes = sorted(set(route for route, _, calls in feed.trips.values() if any(s == first_stop_id for s, _ in calls)))
+    routes_for_stops = {int(stop_codes[0]): routes[:1]}
+
+    timetables = {}
+    for engine, module_name in gtfs_client.TIMETABLE_ENGINES.items():
+        module = importlib.import_module(module_name)
+        timetables[engine] = module.Timetable.load(path, int(os.stat(path).st_mtime), stop_codes, routes_for_stops)
+
+    def arrivals(timetable, now: datetime.datetime, stop_ids: frozenset, routes: dict) -> list[tuple]:
+        return [(arrival_time, timetable.stop_code_by_id[stop_id]) + timetable.trip_info[trip_id][:2]
+                for arrival_time, trip_id, stop_id in timetable.next_departures(now, 15, stop_ids, routes)]
+
+    def lookups(timetable) -> tuple:
+        return (timetable.stop_ids, timetable.route_names, timetable.trip_info, timetable.relevant_trip_ids,
+                timetable.stop_code_by_id, timetable.headsign_by_route_direction)
+
+    reference_engine, reference = next(iter(timetables.items()))
+    queries = 0
+    mismatches = []
+    for engine, timetable in timetables.items():
+        if lookups(timetable) != lookups(reference):
+            mismatches.append({"engine": engine, "lookups": True})
+
+    midnight = datetime.datetime.combine(datetime.date.today() - datetime.timedelta(days=1), datetime.time())
+    selections = [(None, {}), (None, routes_for_stops)] + [(reference.stop_ids_for_codes([code]), {}) for code in stop_codes]
+    for minute in range(0, 3 * 24 * 60, 7):
+        now = midnight + datetime.timedelta(minutes=minute)
+        for stop_ids, routes in selections:
+            queries += 1
+            expected = arrivals(reference, now, stop_ids, routes)
+            for engine, timetable in timetables.items():
+                if timetable is not reference and arrivals(timetable, now, stop_ids, routes) != expected:
+                    mismatches.append({"engine": engine, "time": now.isoformat(), "stop_ids": sorted(stop_ids or [])})
+
+    return {
+        "engines": list(timetables.keys()),
+        "reference": reference_engine,
+        "queries": queries,
+        "mismatches": len(mismatches),
+        "first_mismatches": mismatches[:5],
+    }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def remove_feed_files(feed_name: str) -> None:
+    """ GTFSClient keeps the downloaded feed in /tmp and its index in the cache. Remove them so every run starts cold """
+    for path in [feed_name, feed_name + ".meta", feed_name + ".part", timetable_index.index_path_for(feed_name),
+                 timetable_index.index_path_for(feed_name, ".lite.idx")]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the display against a synthetic GTFS feed")
+    parser.add_argument("--stops", type=int, default=2000, help="stops in the feed")
+    parser.add_argument("--routes", type=int, default=100, help="routes in the feed")
+    parser.add_argument("--trips-per-route", type=int, default=200, help="trips of each route per day")
+    parser.add_argument("--stops-per-trip", type=int, default=30, help="stops each trip calls at")
+    parser.add_argument("--entities", type=int, default=2000, help="TripUpdate entities in the GTFS-R payload")
+    parser.add_argument("--watched-stops", type=int, default=3, help="stops shown on the display")
+    parser.add_argument("--refreshes", type=int, default=20, help="refreshes to time")
+    parser.add_argument("--feed-load-workers", type=int, default=1, 
+                        help="processes used to compile the feed (1 is the sequential path)")
+    parser.add_argument("--timetable-engine", default="pandas", help="timetable engine of the client (pandas or lite)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the results to this file instead of stdout")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="dublinbus-bench-") as work_dir:
+        # Keep the compiled indexes out of the user's cache. The clients run in child processes, which inherit this
+        os.environ["XDG_CACHE_HOME"] = os.path.join(work_dir, "cache")
+        print("Generating the synthetic feed", file=sys.stderr)
+        started = time.perf_counter()
+        feed_file = "bench_{}.zip".format(os.getpid())
+        feed = synthetic_feed.write_gtfs_zip(os.path.join(work_dir, feed_file), args.stops, args.routes,
+                                             args.trips_per_route, args.stops_per_trip, args.seed)
+        entities = synthetic_feed.trip_update_entities(feed, args.entities, seed=args.seed)
+        payloads = {"protobuf": synthetic_feed.encode_protobuf(entities), "json": synthetic_feed.encode_json(entities)}
+        for encoding, payload in payloads.items():
+            with open(os.path.join(work_dir, "trip_updates." + encoding), "wb") as f:
+                f.write(payload)
+        generate_seconds = time.perf_counter() - started
+
+        # The watched stops are spread over the feed, like the stops of a real display
+        step = max(1, len(feed.stop_codes) // args.watched_stops)
+        stop_codes = feed.stop_codes[::step][:args.watched_stops]
+        watched_stop_ids = set("S{}".format(int(code) - 1000) for code in stop_codes)
+        relevant_trip_ids = frozenset(trip_id for trip_id, (_, _, calls) in feed.trips.items()
+                                      if any(stop_id in watched_stop_ids for stop_id, _ in calls))
+
+        server = serve_directory(work_dir)
+        base_url = "http://127.0.0.1:{}/".format(server.server_address[1])
+        feed_name = "/tmp/" + feed_file
+        remove_feed_files(feed_name)
+        try:
+            results = {}
+            for encoding, url in [("protobuf", base_url + "trip_updates.protobuf"),
+                                  ("json", base_url + "trip_updates.json?format=json")]:
+                print("Timing the client with GTFS-R in {} format".format(encoding), file=sys.stderr)
+                # The first run downloads the feed and compiles the timetable index, the second one reuses it
+                cold = run_client(base_url + feed_file, url, stop_codes, args.refreshes, args.feed_load_workers,
+                                  args.timetable_engine)
+                warm = run_client(base_url + feed_file, url, stop_codes, args.refreshes, args.feed_load_workers,
+                                  args.timetable_engine)
+                remove_feed_files(feed_name)
+                results["client_" + encoding] = {"cold": cold, "warm": warm}
+
+            # The same check on the feed of the benchmark, and on a smaller one with the quirks of real feeds
+            print("Comparing the timetable engines", file=sys.stderr)
+            irregular_feed = synthetic_feed.write_gtfs_zip(os.path.join(work_dir, "irregular.zip"), 300, 20, 60, 20,
+                                                           args.seed, irregular=True)
+            results["engines"] = {
+                "synthetic": check_engines(os.path.join(work_dir, feed_file), feed, stop_codes),
+                "irregular": check_engines(os.path.join(work_dir, "irregular.zip"), irregular_feed,
+                                           irregular_feed.stop_codes[::60]),
+            }
+
+            print("Timing the startup", file=sys.stderr)
+            results["startup"] = bench_startup(max(3, args.refreshes // 4))
+
+            print("Timing the GTFS-R parsers", file=sys.stderr)
+            results["parse"] = bench_parse(payloads, relevant_trip_ids, max(3, args.refreshes // 4))
+        finally:
+            server.shutdown()
+            remove_feed_files(feed_name)
+
+        report = {
+            "revision": git_revision(),
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "params": vars(args),
+            "feed": {
+                "zip_bytes": os.path.getsize(os.path.join(work_dir, feed_file)),
+                "trips": len(feed.trips),
+                "stop_times": sum(len(calls) for _, _, calls in feed.trips.values()),
+                "generate_s": generate_seconds,
+            },
+            "results": results,
+        }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if any(check["mismatches"] for check in results["engines"].values()):
+        print("The timetable engines gave different departures", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
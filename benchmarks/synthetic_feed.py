@@ -0,0 +1,256 @@
+# Synthetic GTFS and GTFS-R data for the benchmarks
+# The static feed and the TripUpdates payloads are generated from a seed, so every run
+# at the same scale works on exactly the same data and the results can be compared across commits.
+
+import csv
+import datetime
+import io
+import json
+import os
+import random
+import sys
+import zipfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import gtfs_realtime as rt
+
+
+class SyntheticFeed:
+    """
+    Describes a generated static feed: its stop codes and, for every trip,
+    its route, direction and the stops it calls at (as (stop_id, seconds since midnight) tuples)
+    """
+
+    def __init__(self, stop_codes: list[str], routes: list[str], trips: dict[str, tuple[str, int, list]]) -> None:
+        self.stop_codes = stop_codes
+        self.routes = routes
+        self.trips = trips
+
+
+def write_gtfs_zip(path: str, n_stops: int = 2000, n_routes: int = 100, trips_per_route: int = 200,
+                   stops_per_trip: int = 30, seed: int = 1, irregular: bool = False) -> SyntheticFeed:
+    """
+    Writes a GTFS zip with the given number of stops and routes. Each route serves a random
+    sequence of stops_per_trip stops in both directions, and its trips are spread over the service day,
+    including some past midnight. Stop N has the ID S<N> and the code 1000+N.
+    An irregular feed has the quirks of real feeds: stops that are not timepoints (with one or both times empty),
+    missing and quoted headsigns, missing direction_ids, services only added by calendar_dates.txt,
+    a byte order mark, CRLF line endings and quoted fields in stop_times.txt.
+    """
+    rnd = random.Random(seed)
+    today = datetime.date.today()
+    start_date = (today - datetime.timedelta(days=30)).strftime("%Y%m%d")
+    end_date = (today + datetime.timedelta(days=90)).strftime("%Y%m%d")
+    service_ids = ["WEEKDAY", "WEEKEND", "DAILY"] + (["SPECIAL"] if irregular else [])
+
+    stop_codes = [str(1000 + i) for i in range(n_stops)]
+    routes = ["{}{}".format(r, "ABC"[r % 3]) for r in range(n_routes)]
+    trips = {}
+    trip_rows = []
+    stop_time_rows = []
+    for r in range(n_routes):
+        route_stops = rnd.sample(range(n_stops), min(stops_per_trip, n_stops))
+        for t in range(trips_per_route):
+            direction_id = t % 2
+            trip_id = "T{}_{}".format(r, t)
+            headsign = "{} {}".format("Outbound" if direction_id == 0 else "Inbound", routes[r])
+            direction_field = direction_id
+            if irregular:
+                quirk = rnd.random()
+                if quirk < 0.05:
+                    headsign = ""
+                elif quirk < 0.1:
+                    headsign += ", via City Centre"
+                elif quirk < 0.15:
+                    direction_field = ""
+            trip_rows.append(["R{}".format(r), rnd.choice(service_ids), trip_id, headsign, direction_field])
+            # First departures at 05:00, the last ones run past midnight
+            departure = 5 * 3600 + (t * 20 * 3600) // trips_per_route + rnd.randrange(0, 300)
+            calls = []
+            for stop in (route_stops if direction_id == 0 else route_stops[::-1]):
+                calls.append(("S{}".format(stop), departure))
+                departure += rnd.randrange(60, 180)
+            for sequence, (stop_id, seconds) in enumerate(calls):
+                hms = "{}:{:02d}:{:02d}".format(seconds // 3600, seconds % 3600 // 60, seconds % 60)
+                arrival_time, departure_time = hms, hms
+                if irregular and 0 < sequence < len(calls) - 1:
+                    quirk = rnd.random()
+                    if quirk < 0.1:
+                        arrival_time, departure_time = "", ""
+                    elif quirk < 0.15:
+                        arrival_time = ""
+                    elif quirk < 0.2:
+                        departure_time = ""
+                stop_time_rows.append([trip_id, arrival_time, departure_time, stop_id, sequence + 1])
+            trips[trip_id] = (routes[r], direction_id, calls)
+
+    tables = {
+        "agency.txt": (["agency_id", "agency_name", "agency_url", "agency_timezone"],
+                       [["1", "Synthetic Bus", "http://localhost", "Europe/Dublin"]]),
+        "stops.txt": (["stop_id", "stop_code", "stop_name", "stop_lat", "stop_lon"],
+                      [["S{}".format(i), stop_codes[i], "Stop {}".format(i), 53.35, -6.26] for i in range(n_stops)]),
+        "routes.txt": (["route_id", "agency_id", "route_short_name", "route_long_name", "route_type"],
+                       [["R{}".format(r), "1", routes[r], "Route {}".format(routes[r]), 3] for r in range(n_routes)]),
+        "calendar.txt": (["service_id", "monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday",
+                          "start_date", "end_date"],
+                         [["WEEKDAY", 1, 1, 1, 1, 1, 0, 0, start_date, end_date],
+                          ["WEEKEND", 0, 0, 0, 0, 0, 1, 1, start_date, end_date],
+                          ["DAILY", 1, 1, 1, 1, 1, 1, 1, start_date, end_date]]),
+        "calendar_dates.txt": (["service_id", "date", "exception_type"],
+                               [["WEEKDAY", (today + datetime.timedelta(days=7)).strftime("%Y%m%d"), 2]] +
+                               [["SPECIAL", (today + datetime.timedelta(days=d)).strftime("%Y%m%d"), 1]
+                                for d in range(-1, 2) if irregular]),
+        "trips.txt": (["route_id", "service_id", "trip_id", "trip_headsign", "direction_id"], trip_rows),
+        "stop_times.txt": (["trip_id", "arrival_time", "departure_time", "stop_id", "stop_sequence"], stop_time_rows),
+    }
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as z:
+        for filename, (header, rows) in tables.items():
+            buffer = io.StringIO()
+            if irregular:
+                buffer.write("\ufeff")
+                quoting = csv.QUOTE_NONNUMERIC if filename == "stop_times.txt" else csv.QUOTE_MINIMAL
+                writer = csv.writer(buffer, lineterminator="\r\n", quoting=quoting)
+            else:
+                writer = csv.writer(buffer, lineterminator="\n")
+            writer.writerow(header)
+            writer.writerows(rows)
+            z.writestr(filename, buffer.getvalue())
+
+    return SyntheticFeed(stop_codes, routes, trips)
+
+
+def trip_update_entities(feed: SyntheticFeed, n_entities: int = 1000, canceled_ratio: float = 0.05,
+                         added_ratio: float = 0.02, seed: int = 1) -> list[dict]:
+    """
+    Returns TripUpdate entities, shaped like the JSON encoding of GTFS-R, for random trips of the feed.
+    Most carry delays for every stop of their trip, some cancel their trip, and some add trips
+    that are not in the static feed.
+    """
+    rnd = random.Random(seed)
+    now = datetime.datetime.now()
+    now_epoch = int(now.timestamp())
+    today = now.strftime("%Y%m%d")
+    trip_ids = sorted(feed.trips)
+
+    entities = []
+    for i in range(n_entities):
+        trip_id = rnd.choice(trip_ids)
+        route, direction_id, calls = feed.trips[trip_id]
+        choice = rnd.random()
+        if choice < canceled_ratio:
+            trip = {"trip_id": trip_id, "schedule_relationship": "CANCELED"}
+            stop_time_updates = []
+        elif choice < canceled_ratio + added_ratio:
+            # An extra trip that started a few minutes ago and calls at the same stops as this one
+            started = now - datetime.timedelta(minutes=rnd.randrange(1, 30))
+            trip = {"trip_id": "ADDED_{}".format(i), "route_id": "R{}".format(feed.routes.index(route)),
+                    "direction_id": direction_id, "start_time": started.strftime("%H:%M:%S"), "start_date": today,
+                    "schedule_relationship": "ADDED"}
+            arrival = now_epoch + rnd.randrange(60, 600)
+            stop_time_updates = []
+            for sequence, (stop_id, _) in enumerate(calls):
+                stop_time_updates.append({"stop_sequence": sequence + 1, "stop_id": stop_id,
+                                          "arrival": {"time": arrival}, "schedule_relationship": "SCHEDULED"})
+                arrival += rnd.randrange(60, 180)
+        else:
+            trip = {"trip_id": trip_id, "schedule_relationship": "SCHEDULED"}
+            delay = rnd.randrange(-120, 900)
+            stop_time_updates = []
+            for sequence, (stop_id, _) in enumerate(calls):
+                stop_time_updates.append({"stop_sequence": sequence + 1, "stop_id": stop_id,
+                                          "arrival": {"delay": delay}, "departure": {"delay": delay},
+                                          "schedule_relationship": "SCHEDULED"})
+                delay += rnd.randrange(-30, 60)
+
+        entities.append({"id": "E{}".format(i), "trip_update": {"trip": trip, "stop_time_update": stop_time_updates,
+                                                                "timestamp": now_epoch}})
+    return entities
+
+
+def encode_json(entities: list[dict]) -> bytes:
+    """ Encodes the entities as a GTFS-R FeedMessage in the JSON format """
+    header = {"gtfs_realtime_version": "2.0", "incrementality": "FULL_DATASET", "timestamp": int(datetime.datetime.now().timestamp())}
+    return json.dumps({"header": header, "entity": entities}).encode("utf-8")
+
+
+def _varint(value: int) -> bytes:
+    if value < 0:
+        value += 1 << 64
+    out = bytearray()
+    while True:
+        b = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(b | 0x80)
+        else:
+            out.append(b)
+            return bytes(out)
+
+
+def _field_varint(field_number: int, value: int) -> bytes:
+    return _varint(field_number << 3 | rt.WIRE_VARINT) + _varint(value)
+
+
+def _field_bytes(field_number: int, value) -> bytes:
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+    return _varint(field_number << 3 | rt.WIRE_LENGTH_DELIMITED) + _varint(len(value)) + value
+
+
+def _enum_value(names: dict[int, str], name: str) -> int:
+    return next(number for number, enum_name in names.items() if enum_name == name)
+
+
+def _encode_trip(trip: dict) -> bytes:
+    out = b""
+    for key, field_number in [("trip_id", rt.TRIP_TRIP_ID), ("start_time", rt.TRIP_START_TIME),
+                              ("start_date", rt.TRIP_START_DATE), ("route_id", rt.TRIP_ROUTE_ID)]:
+        if key in trip:
+            out += _field_bytes(field_number, trip[key])
+    if "schedule_relationship" in trip:
+        out += _field_varint(rt.TRIP_SCHEDULE_RELATIONSHIP,
+                             _enum_value(rt.TRIP_SCHEDULE_RELATIONSHIPS, trip["schedule_relationship"]))
+    if "direction_id" in trip:
+        out += _field_varint(rt.TRIP_DIRECTION_ID, trip["direction_id"])
+    return out
+
+
+def _encode_stop_time_event(event: dict) -> bytes:
+    out = b""
+    for key, field_number in [("delay", rt.STOP_TIME_EVENT_DELAY), ("time", rt.STOP_TIME_EVENT_TIME),
+                              ("uncertainty", rt.STOP_TIME_EVENT_UNCERTAINTY)]:
+        if key in event:
+            out += _field_varint(field_number, event[key])
+    return out
+
+
+def _encode_stop_time_update(update: dict) -> bytes:
+    out = b""
+    if "stop_sequence" in update:
+        out += _field_varint(rt.STOP_TIME_UPDATE_STOP_SEQUENCE, update["stop_sequence"])
+    if "arrival" in update:
+        out += _field_bytes(rt.STOP_TIME_UPDATE_ARRIVAL, _encode_stop_time_event(update["arrival"]))
+    if "departure" in update:
+        out += _field_bytes(rt.STOP_TIME_UPDATE_DEPARTURE, _encode_stop_time_event(update["departure"]))
+    if "stop_id" in update:
+        out += _field_bytes(rt.STOP_TIME_UPDATE_STOP_ID, update["stop_id"])
+    if "schedule_relationship" in update:
+        out += _field_varint(rt.STOP_TIME_UPDATE_SCHEDULE_RELATIONSHIP,
+                             _enum_value(rt.STOP_SCHEDULE_RELATIONSHIPS, update["schedule_relationship"]))
+    return out
+
+
+def _encode_entity(entity: dict) -> bytes:
+    trip_update = entity["trip_update"]
+    encoded_trip_update = _field_bytes(rt.TRIP_UPDATE_TRIP, _encode_trip(trip_update["trip"]))
+    for update in trip_update.get("stop_time_update", []):
+        encoded_trip_update += _field_bytes(rt.TRIP_UPDATE_STOP_TIME_UPDATE, _encode_stop_time_update(update))
+    if "timestamp" in trip_update:
+        encoded_trip_update += _field_varint(rt.TRIP_UPDATE_TIMESTAMP, trip_update["timestamp"])
+    return _field_bytes(rt.FEED_ENTITY_ID, entity["id"]) + _field_bytes(rt.FEED_ENTITY_TRIP_UPDATE, encoded_trip_update)
+
+
+def encode_protobuf(entities: list[dict]) -> bytes:
+    """ Encodes the entities as a GTFS-R FeedMessage in the protobuf format """
+    header = _field_bytes(1, "2.0") + _field_varint(2, 0) + _field_varint(3, int(datetime.datetime.now().timestamp()))
+    return _field_bytes(1, header) + b"".join(_field_bytes(rt.FEED_MESSAGE_ENTITY, _encode_entity(e)) for e in entities)
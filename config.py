@@ -27,24 +27,81 @@ class Config:
     def update_interval_seconds(self) -> int:
         return self.config.get("update-interval-seconds")
 
+    @property
+    def gtfs_api_max_interval_seconds(self) -> int:
+        return self.config.get("gtfs-r-max-interval-seconds")
+
+    @property
+    def gtfs_api_daily_request_budget(self) -> int:
+        return self.config.get("gtfs-r-daily-request-budget")
+
+    @property
+    def feed_update_interval_hours(self) -> int:
+        return self.config.get("feed-update-interval-hours")
+
+    @property
+    def server_url(self) -> str:
+        return self.config.get("server-url")
+
+    @property
+    def server_port(self) -> int:
+        return self.config.get("server-port")
+
+    @property
+    def feed_load_workers(self) -> int:
+        return self.config.get("feed-load-workers")
+
+    @property
+    def timetable_engine(self) -> str:
+        return self.config.get("timetable-engine") or "pandas"
+
+    @property
+    def snapshot_file(self) -> str:
+        return self.config.get("snapshot-file")
+
+    @property
+    def metrics_port(self) -> int:
+        return self.config.get("metrics-port")
+
+    @property
+    def metrics_file(self) -> str:
+        return self.config.get("metrics-file")
+
     @property
     def font_file(self) -> str:
         return self.config.get("font-file")
 
     @property
     def stop_codes(self) -> list[str]:
-        return [str(s["stop_id"]) for s in self.config.get("stops")]
+        return Config.__stop_codes(self.config.get("stops"))
 
     def minutes_to_stop(self, stop_id) -> int: 
         minutes = self.walk_time_by_stop.get(stop_id, 0)
         return minutes
 
     def routes_for_stops(self) -> map:
+        return Config.__routes_for_stops(self.config.get("stops"))
+
+    def displays(self) -> dict[str, tuple[list[str], map]]:
+        """
+        Returns the stop codes and the routes for each stop of every display served in server mode,
+        by display name. Without a "displays" section there is one display, "default", with the configured stops.
+        """
+        displays = self.config.get("displays") or {"default": {"stops": self.config.get("stops")}}
+        return {str(name): (Config.__stop_codes(display["stops"]), Config.__routes_for_stops(display["stops"]))
+                for name, display in displays.items()}
+
+    @staticmethod
+    def __stop_codes(stops: list[dict]) -> list[str]:
+        return [str(s["stop_id"]) for s in stops]
+
+    @staticmethod
+    def __routes_for_stops(stops: list[dict]) -> map:
         result = {}
 
-        for s in self.config.get("stops"):
+        for s in stops:
             for r in s.get("routes", []):
                 routes = (result.get(s.get("stop_id")) or [])
                 routes.append(r)
                 result[s.get("stop_id")] = routes
-        return result
\ No newline at end of file
+        return result
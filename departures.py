@@ -0,0 +1,53 @@
+from array import array
+import bisect
+
+
+class ServiceDayDepartures:
+    """
+    The departures of one service day at the configured stops, sorted by arrival time.
+    A cursor remembers where the previous query stopped, so that as the clock moves forward
+    each query only needs a binary search over the departures that are still to come.
+    """
+
+    def __init__(self, arrival_times, trip_ids, stop_ids) -> None:
+        """
+        arrival_times are in seconds since the start of the service day and must be sorted.
+        trip_ids and stop_ids are the matching trip and stop of each departure.
+        """
+        self._arrival_times = array("i", arrival_times)
+        self._trip_ids = list(trip_ids)
+        self._stop_ids = list(stop_ids)
+        self._cursor = 0
+
+    def __len__(self) -> int:
+        return len(self._arrival_times)
+
+    def next_departures(self, seconds: int, n: int, stop_ids: frozenset = None,
+                        is_wanted = None) -> list[tuple[int, str, str]]:
+        """
+        Returns up to n (arrival_time, trip_id, stop_id) tuples for the departures that arrive after
+        the given number of seconds since the start of the service day, in order of arrival.
+        If stop_ids is given, only the departures from those stops are returned. If is_wanted is given,
+        only the departures for which is_wanted(trip_id, stop_id) is true are returned.
+        """
+        arrival_times = self._arrival_times
+        if self._cursor > 0 and arrival_times[self._cursor - 1] > seconds:
+            # The clock went backwards (e.g. it was adjusted by NTP). Search from the beginning again
+            self._cursor = 0
+
+        self._cursor = bisect.bisect_right(arrival_times, seconds, lo=self._cursor)
+        if stop_ids is None and is_wanted is None:
+            end = min(self._cursor + n, len(arrival_times))
+            return [(arrival_times[i], self._trip_ids[i], self._stop_ids[i]) for i in range(self._cursor, end)]
+
+        departures = []
+        for i in range(self._cursor, len(arrival_times)):
+            stop_id = self._stop_ids[i]
+            if stop_ids is not None and not stop_id in stop_ids:
+                continue
+            if is_wanted is not None and not is_wanted(self._trip_ids[i], stop_id):
+                continue
+            departures.append((arrival_times[i], self._trip_ids[i], stop_id))
+            if len(departures) == n:
+                break
+        return departures
@@ -0,0 +1,129 @@
+from arrival_times import ArrivalTime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import queue
+import requests
+import sys
+import threading
+
+# Server mode: one GTFSClient polls GTFS-R for the stops of all the displays at a site,
+# and each display fetches its own arrival times from it over HTTP.
+
+class DisplayServer:
+    """
+    Wraps the GTFSClient of the server. After every refresh the arrival times of each display
+    are computed and encoded once, and then served as they are to any number of requests.
+    """
+
+    def __init__(self, displays: dict[str, tuple[list[str], map]], port: int) -> None:
+        """
+        displays maps the name of each display to its stop codes and routes for stops, as returned by Config.displays().
+        The port is bound right away, so that a port in use is found before the timetable is loaded. The GTFSClient
+        is set as client once it's loaded; until then the displays are told to try again later.
+        """
+        self.client = None
+        self.displays = displays
+        self._documents = {}
+
+        server = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server._serve(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._http_server = ThreadingHTTPServer(("", port), Handler)
+        self._http_server.daemon_threads = True
+        self._http_thread = threading.Thread(target=self._http_server.serve_forever, name="display-server", daemon=True)
+        self._http_thread.start()
+        print("Serving arrival times for displays {} on port {}".format(", ".join(displays), port), file=sys.stderr)
+
+    def refresh(self) -> None:
+        """ Refresh the arrival times, and publish them to the displays """
+        self.client.refresh()
+        self.publish()
+
+    def publish(self) -> None:
+        """ Compute and encode the arrival times of each display """
+        documents = {}
+        for name, (stop_codes, routes_for_stops) in self.displays.items():
+            try:
+                arrivals = self.client.arrivals_for(stop_codes, routes_for_stops)
+                documents[name] = json.dumps([arrival.to_dict() for arrival in arrivals]).encode("utf-8")
+            except Exception as e:
+                print("Could not compute the arrivals of display {}: {}".format(name, str(e)), file=sys.stderr)
+                if name in self._documents:
+                    documents[name] = self._documents[name]
+
+        documents[""] = json.dumps(sorted(self.displays)).encode("utf-8")
+        # Replacing the reference is atomic: requests in progress keep the documents they started with
+        self._documents = documents
+
+    def shutdown(self) -> None:
+        self._http_server.shutdown()
+        self._http_server.server_close()
+        if self.client is not None:
+            self.client.close()
+
+    def _serve(self, request: BaseHTTPRequestHandler) -> None:
+        """ GET /displays lists the displays, GET /displays/<name> returns the arrival times of one """
+        path = request.path.split("?")[0].rstrip("/")
+        if path == "/displays":
+            name = ""
+        elif path.startswith("/displays/"):
+            name = path[len("/displays/"):]
+        else:
+            request.send_error(404)
+            return
+
+        document = self._documents.get(name)
+        if document is None:
+            # Either an unknown display, or the first refresh has not finished yet
+            request.send_error(404 if name not in self.displays and name != "" else 503)
+            return
+
+        request.send_response(200)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(document)))
+        request.end_headers()
+        request.wfile.write(document)
+
+
+class RemoteClient:
+    """
+    Thin client mode: gets the arrival times of this display from a DisplayServer
+    instead of loading the timetable and polling GTFS-R.
+    """
+
+    def __init__(self, server_url: str, update_queue: queue.Queue) -> None:
+        """ server_url is the URL of this display on the server, e.g. http://server:8080/displays/default """
+        self.server_url = server_url
+        self._update_queue = update_queue
+        self._session = requests.Session()
+
+    def refresh(self) -> None:
+        """
+        Fetch and enqueue the arrival times of this display
+        """
+        try:
+            response = self._session.get(self.server_url, timeout=(2, 10))
+            if response.status_code != 200:
+                print("Display server sent non-OK response: {}".format(response.status_code), file=sys.stderr)
+                return
+
+            arrivals = [ArrivalTime.from_dict(d) for d in response.json()]
+            # Only the latest update matters, drop an old one if the display has fallen behind
+            try:
+                self._update_queue.put_nowait(arrivals)
+            except queue.Full:
+                try:
+                    self._update_queue.get_nowait()
+                except queue.Empty:
+                    pass
+                self._update_queue.put_nowait(arrivals)
+        except Exception as e:
+            print("Polling the display server failed: {}".format(str(e)), file=sys.stderr)
+
+    def close(self) -> None:
+        self._session.close()
@@ -1,218 +1,122 @@
 from arrival_times import ArrivalTime
+import arrivals_snapshot
 import datetime
 import gc
-import gtfs_kit as gk
-import json
+import gtfs_realtime
+import heapq
+import importlib
+import itertools
+import metrics
+import multiprocessing
 import os
-import pandas as pd
+from poll_scheduler import PollScheduler, parse_retry_after
 import queue
 import refresh_feed
 import requests
 import sys
+import threading
 import time
-import zipfile
+from timetable_base import BaseTimetable, routes_for_stop
+
+# Collect generation 0 after this many allocations instead of the default 700. A refresh allocates
+# many short-lived objects that reference counting frees on its own, so looking for cycles among them
+# that often only adds pauses. The older generations are collected proportionally less often too.
+GC_THRESHOLDS = (10000, 20, 20)
+
+# Save the arrivals snapshot at most this often, to spare the SD card
+SNAPSHOT_INTERVAL_SECONDS = 5 * 60
+# GTFS-R deltas and cancellations older than this are not restored from the snapshot
+SNAPSHOT_MAX_DELTAS_AGE_SECONDS = 15 * 60
+
+# How long to wait for the process compiling a new feed to stop when the program exits, before killing it
+COMPILE_STOP_TIMEOUT_SECONDS = 5
+
+# Timetable engines, by the name used in config.yaml, and the modules that implement them.
+# Each module has a Timetable class with load() and compile_index() methods (see timetable_base.py).
+# They are imported when the client is created, so that the pandas engine is only loaded if it's used
+TIMETABLE_ENGINES = {
+    "pandas": "timetable",
+    "lite": "lite_timetable",
+}
 
 class GTFSClient:
     def __init__(self, feed_url: str, gtfs_r_url: str, gtfs_r_api_key: str, 
                  stop_codes: list[str], routes_for_stops: dict[str, str],
-                 update_queue: queue.Queue, update_interval_seconds: int = 60):
+                 update_queue: queue.Queue, update_interval_seconds: int = 60,
+                 feed_update_interval_seconds: int = 12 * 3600, feed_load_workers: int = None,
+                 gtfs_r_max_interval_seconds: int = 15 * 60, gtfs_r_daily_request_budget: int = None,
+                 snapshot_file: str = None, timetable_engine: str = "pandas"):
 
         self.stop_codes = stop_codes
         self.routes_for_stops = routes_for_stops
 
-        feed_name = '/tmp/' + feed_url.split('/')[-1]
+        self.feed_url = feed_url
+        self.feed_name = '/tmp/' + feed_url.split('/')[-1]
         self.gtfs_r_url = gtfs_r_url
         self.gtfs_r_api_key = gtfs_r_api_key
+        # Compile the feed with all the cores, unless told otherwise. One core means the sequential, low-memory path
+        self.feed_load_workers = feed_load_workers or os.cpu_count() or 1
 
         # Make sure that the feed file is up to date
         try:
-            last_mtime = int(os.stat(feed_name).st_mtime)
+            last_mtime = int(os.stat(self.feed_name).st_mtime)
         except:
             last_mtime = 0
 
-        _, new_mtime = refresh_feed.update_local_file_from_url_v1(last_mtime, feed_name, feed_url)
+        with metrics.timed("feed_download"):
+            _, self.feed_mtime = refresh_feed.update_local_file_from_url_v2(last_mtime, self.feed_name, feed_url)
 
         # Load the feed
-        self.feed = self._read_feed(feed_name, dist_units='km')
-        gc.collect()
-        self.stop_ids = self.__wanted_stop_ids()
+        if not timetable_engine in TIMETABLE_ENGINES:
+            raise ValueError("Unknown timetable engine {}, it must be one of {}".format(
+                timetable_engine, ", ".join(TIMETABLE_ENGINES.keys())))
+        self.timetable_engine = importlib.import_module(TIMETABLE_ENGINES[timetable_engine])
+        with metrics.timed("timetable_load"):
+            self.timetable = self.timetable_engine.Timetable.load(self.feed_name, self.feed_mtime, stop_codes,
+                                                                  routes_for_stops, workers=self.feed_load_workers)
+        GTFSClient.__freeze_long_lived_objects()
+        gc.set_threshold(*GC_THRESHOLDS)
         self.deltas = {}
         self.canceled_trips = set()
         self.added_stops = []
 
+        # Start from the last known GTFS-R data if it's recent, in case polling GTFS-R fails at first
+        self.snapshot_file = snapshot_file
+        self._next_snapshot = 0
+        snapshot = arrivals_snapshot.load(snapshot_file) if snapshot_file else None
+        if snapshot is not None and snapshot.age_seconds < SNAPSHOT_MAX_DELTAS_AGE_SECONDS:
+            self.deltas = snapshot.deltas
+            self.canceled_trips = snapshot.canceled_trips
+            self.added_stops = snapshot.added_stops
+
+        # Check for a new version of the feed every so often
+        self._feed_update_interval_seconds = feed_update_interval_seconds
+        self._next_feed_check = time.monotonic() + feed_update_interval_seconds
+        self._feed_reload_thread = None
+        self._compile_process = None
+        self._closed = False
+
         # Schedule refresh       
         self._update_queue = update_queue
+        self.dropped_updates = 0
         if update_interval_seconds and update_queue: 
             self._update_interval_seconds = update_interval_seconds
 
-    def _read_feed(self, path: str, dist_units: str) -> gk.Feed:
-        """
-        NOTE: This helper method was extracted from gtfs_kit.feed to modify it
-        to only load the stop_times for the stops we are interested in,
-        because loading the entire feed would use more memory than the Raspberry Pi Zero W has.
-
-        This version also reads CSV data straight from the zip file to avoid
-        wearing out the Pi's SD card.
-        """
-        files_to_load = [
-            # List of feed files to load. stop_times.txt is loaded separately.
-            'trips.txt',
-            'routes.txt',
-            'calendar.txt',
-            'calendar_dates.txt',
-            'stops.txt',
-            'agency.txt'
-        ]
-
-        if not os.path.exists(path):
-            raise ValueError("Path {} does not exist".format(path))
-
-        print("Loading GTFS feed {}".format(path), file=sys.stderr)
-        gc.collect()
-
-        feed_dict = {table: None for table in gk.cs.GTFS_REF["table"]}
-        with zipfile.ZipFile(path) as z:
-            for filename in files_to_load:
-                table = filename.split(".")[0]
-                # read the file
-                with z.open(filename) as f:
-                    df = pd.read_csv(f, dtype=gk.cs.DTYPE, encoding="utf-8-sig")
-                    if not df.empty:
-                        feed_dict[table] = gk.cn.clean_column_names(df)
-
-                    gc.collect()
-
-            # Finally, load stop_times.txt
-            # Obtain the list of IDs of the desired stops. This is similar to what __wanted_stop_ids() does, 
-            # but without a dependency on a fully formed feed object
-            wanted_stop_ids = feed_dict.get("stops")[feed_dict.get("stops")["stop_code"].isin(self.stop_codes)]["stop_id"]
-            with z.open("stop_times.txt") as f:
-                iter_csv = pd.read_csv(f, iterator=True, chunksize=1000, dtype=gk.cs.DTYPE, encoding="utf-8-sig")
-                df = pd.concat([chunk[chunk["stop_id"].isin(wanted_stop_ids)] for chunk in iter_csv])
-
-            gc.collect()
-
-            if not df.empty:
-                # Fix arrival and departure times so that comparisons work the way they are expected to
-                df["arrival_time"] = df.apply(lambda row: row["arrival_time"] if len(row["arrival_time"]) == 8 else "0"+row["arrival_time"], axis=1)
-                gc.collect()
-                df["departure_time"] = df.apply(lambda row: row["departure_time"] if len(row["departure_time"]) == 8 else "0"+row["departure_time"], axis=1)
-                gc.collect()
-                feed_dict["stop_times"] = gk.cn.clean_column_names(df)
-                gc.collect()
-
-        feed_dict["dist_units"] = dist_units
-
-        # Create feed
-        return gk.Feed(**feed_dict)
-
-
-    def __wanted_stop_ids(self) -> pd.core.frame.DataFrame:
-        """
-        Return a DataFrame with the ID and names of the chosen stop(s) as requested in station_names
-        """
-        stops = self.feed.stops[self.feed.stops["stop_code"].isin(self.stop_codes)]
-        if stops.empty: 
-            raise Exception("Stops is empty!")
-        return stops["stop_id"]
-
-
-    def __service_ids_active_at(self, when: datetime) -> pd.core.frame.DataFrame:
-        """
-        Returns the service IDs active at a particular point in time
-        """
-        todays_date = when.strftime("%Y%m%d")
-        todays_weekday = when.strftime("%A").lower()
-        active_calendars = self.feed.calendar.query('start_date <= @todays_date and end_date >= @todays_date and {} == 1'.format(todays_weekday))
-        return active_calendars
-
-
-    def __current_calendars(self) -> pd.core.frame.DataFrame:
-        """
-        Filter the calendar entries to find all services that apply for today.
-        Returns an empty list if none do.
-        """
-        
-        # Take the service IDs active today
-        now = datetime.datetime.now()
-        now_active = self.__service_ids_active_at(now)
-        if now_active.empty:
-            print("There are no service IDs for today!")
-
-        # Merge with the service IDs for tomorrow (in case the number of trips spills over to tomorrow)
-        tomorrow = datetime.datetime.now() + datetime.timedelta(days=1)
-        tomorrow_active = self.__service_ids_active_at(tomorrow)
-        if tomorrow_active.empty:
-            print("There are no service IDs for tomorrow!")
-
-        #active_calendars = pd.concat([now_active, tomorrow_active])
-        active_calendars = now_active
-        if active_calendars.empty:
-            print("The concatenation of today and tomorrow's calendars is empty. This should not happen.")
-
-        return active_calendars
-
-
-    def __current_service_ids(self) -> pd.core.series.Series:
-        """
-        Filter the calendar entries to find all service ids that apply for today.
-        Returns an empty list if none do.
-        """
-        return self.__current_calendars()["service_id"]
-
-
-    def __trip_ids_for_service_ids(self, service_ids: pd.core.series.Series) -> pd.core.series.Series:
-        """
-        Returns a dataframe with the trip IDs for the given service IDs 
-        """
-        trips = self.feed.trips[self.feed.trips["service_id"].isin(service_ids)]
-        if trips.empty:
-            print("There are no active trips!")
-
-        return trips["trip_id"]
-
+        # Poll GTFS-R on every refresh while a bus is due soon, less often otherwise
+        self.poll_scheduler = PollScheduler(min_interval_seconds=update_interval_seconds or 60,
+                                            max_interval_seconds=gtfs_r_max_interval_seconds,
+                                            daily_budget=gtfs_r_daily_request_budget)
 
-    def __next_n_buses(self, 
-                    trip_ids: pd.core.series.Series,
-                    n: int) -> pd.core.frame.DataFrame:
-        now = datetime.datetime.now()
-        current_time = now.strftime("%H:%M:%S")
-        next_stops = self.feed.stop_times[self.feed.stop_times["stop_id"].isin(self.stop_ids)
-                                    & self.feed.stop_times["trip_id"].isin(trip_ids)
-                                    & (self.feed.stop_times["arrival_time"] > current_time)]
-        next_stops = next_stops.sort_values("arrival_time")
-        return next_stops[:n][["trip_id", "arrival_time", "stop_id"]]
-
-
-    def __join_data(self, next_buses: pd.core.frame.DataFrame) -> pd.core.frame.DataFrame:
-        """
-        Enriches the stop data with the information from other dataframes in the feed
-        """
-        joined_data = (next_buses
-            .join(self.feed.trips.set_index("trip_id"), on="trip_id")
-            .join(self.feed.stops.set_index("stop_id"), on="stop_id")
-            .join(self.feed.routes.set_index("route_id"), on="route_id"))   
-
-        return joined_data 
-
-
-    def __filter_routes_by_stops(self, next_buses: pd.core.frame.DataFrame) -> pd.core.frame.DataFrame:
+    @staticmethod
+    def __freeze_long_lived_objects() -> None:
         """
-        Takes a dataframe of a set of bus arrivals and only shows the routes we are interested in 
-        for the given stops (this is to eliminate routes that stop in more than one of our stops)
+        The timetable is kept until the next feed is loaded, so it's moved out of the garbage collector's way:
+        frozen objects are not scanned by any later collection. The previously frozen objects (e.g. the old
+        timetable) are unfrozen and collected first. This is the only full collection, once per feed load.
         """
-        ids_to_delete = []
-
-        for index, next_bus in next_buses.iterrows():
-            stop_number = next_bus["stop_code"]
-            route = next_bus["route_short_name"]
-            routes_for_stop = self.routes_for_stops.get(int(stop_number), [])
-            if len(routes_for_stop) > 0 and not route in routes_for_stop:
-                # we should not show this entry. Note the ID
-                ids_to_delete.append(index)
-        
-        next_buses.drop(index=ids_to_delete, inplace=True)
-        return next_buses
+        gc.unfreeze()
+        gc.collect()
+        gc.freeze()
 
     @staticmethod
     def __time_to_seconds(s: str) -> int:
@@ -223,59 +127,53 @@ class GTFSClient:
         return int(sx[0]) * 3600 + int(sx[1]) * 60 + int (sx[2])
 
     @staticmethod
-    def __due_in_seconds(time_str: str) -> int:
-        """
-        Returns the number of seconds in the future that the time_str (format hh:mm:ss) is
-        """
-        now = datetime.datetime.now().strftime("%H:%M:%S")
-        tnow = GTFSClient.__time_to_seconds(now)
-        tstop = GTFSClient.__time_to_seconds(time_str)
-        if tstop > tnow:
-            return tstop - tnow
-        else:
-            # If the stop time is less than the current time, the stop is tomorrow
-            return tstop + 86400 - tnow
+    def __seconds_since_midnight(when: datetime.datetime) -> int:
+        return when.hour * 3600 + when.minute * 60 + when.second
 
 
-    def __lookup_headsign_by_route(self, route_id: str, direction_id: int) -> str: 
+    @staticmethod
+    def __wants_trip_update(timetable: BaseTimetable, trip: dict) -> bool:
         """
-        Look up a destination string in Trips from the route and direction
+        Decides from its trip descriptor whether a GTFS-R trip update can affect our stops.
+        Added trips are not in the static feed, so they are kept if they belong to a route that serves our stops.
         """
-        trips = self.feed.trips
-        destination = trips[(trips["route_id"] == route_id) & (trips["direction_id"] == direction_id)].head(1)["trip_headsign"].item()
-        # For some reason destination sometimes isn't a string. Try to find out why
-        if not destination.__class__ == str:
-            sys.stderr.write("Destination not found for route " + str(route_id) + ", direction " + str(direction_id) + "\n")
-            destination = "---- ?????? ----"
-        
-        return destination
+        if trip.get("schedule_relationship") == "ADDED":
+            return trip.get("route_id") in timetable.route_names
+        return trip.get("trip_id") in timetable.relevant_trip_ids
 
 
-    def __poll_gtfsr_deltas(self) -> tuple[dict, list, list]:
+    def __poll_gtfsr_deltas(self, timetable: BaseTimetable) -> tuple[dict, list, list]:
+        wants_trip_update = lambda trip: GTFSClient.__wants_trip_update(timetable, trip)
         try:
             # Poll GTFS-R API
             if self.gtfs_r_api_key != "":
                 headers = {"x-api-key": self.gtfs_r_api_key}
-                response = requests.get(url = self.gtfs_r_url, headers = headers, timeout=(2, 10))
-                if response.status_code != 200:
-                    print("GTFS-R sent non-OK response: {}\n{}".format(response.status_code, response.text))
-                    return {}, [], []
-
-                deltas_json = json.loads(response.text)
+                self.poll_scheduler.record_request()
+                with requests.get(url = self.gtfs_r_url, headers = headers, timeout=(2, 10), stream=True) as response:
+                    if response.status_code != 200:
+                        print("GTFS-R sent non-OK response: {}\n{}".format(response.status_code, response.text))
+                        # 429 (too many requests) and 503 (unavailable) can tell us how long to wait
+                        self.poll_scheduler.record_failure(parse_retry_after(response.headers.get("Retry-After")))
+                        return {}, [], []
+
+                    # Entities are decoded while they are downloaded, so only keep the ones we use
+                    if "format=json" in self.gtfs_r_url:
+                        response.raw.decode_content = True
+                        entities = list(gtfs_realtime.iter_trip_updates_json(response.raw, wants_trip_update))
+                    else:
+                        entities = list(gtfs_realtime.iter_trip_updates_protobuf(response.iter_content(chunk_size=65536), 
+                                                                                 wants_trip_update))
             else:
-                deltas_json = json.load(open("example.json"))
+                with open("example.json") as f:
+                    entities = list(gtfs_realtime.iter_trip_updates_json(f, wants_trip_update))
 
             deltas = {}
             canceled_trips = set()
             added_stops = []
 
-            # Pre-compute some data to use for added trips:
-            relevant_service_ids = self.__current_service_ids()
-            relevant_trips = self.feed.trips[self.feed.trips["service_id"].isin(relevant_service_ids)]
-            relevant_route_ids = set(relevant_trips["route_id"])
             today = datetime.date.today().strftime("%Y%m%d")
 
-            for e in deltas_json.get("entity", []):
+            for e in entities:
                 try:
                     trip_update = e.get("trip_update")
                     trip = trip_update.get("trip")
@@ -283,6 +181,9 @@ class GTFSClient:
                     trip_action = trip.get("schedule_relationship")
                     if  trip_action == "SCHEDULED":
                         for u in e.get("trip_update", {}).get("stop_time_update", []): 
+                            # Only keep the deltas for our stops
+                            if not u.get("stop_id") in timetable.stop_ids:
+                                continue
                             delay = u.get("arrival", u.get("departure", {})).get("delay", 0)
                             deltas_for_trip = (deltas.get(trip_id) or {})
                             deltas_for_trip[u.get("stop_id")] = delay
@@ -295,26 +196,25 @@ class GTFSClient:
                         direction_id = trip.get("direction_id")
 
                         # Check if the route is part of the routes we care about
-                        if not route_id in relevant_route_ids:
+                        if not route_id in timetable.route_names:
                             continue
 
                         # And that it's for today
-                        current_time = datetime.datetime.now().strftime("%H:%M:%S")
-                        if start_date > today or start_time > current_time:
+                        seconds_now = GTFSClient.__seconds_since_midnight(datetime.datetime.now())
+                        if start_date > today or GTFSClient.__time_to_seconds(start_time) > seconds_now:
                             continue
 
                         # Look for the entry for any of the stops we want
-                        wanted_stop_ids = self.__wanted_stop_ids()
                         for stop_time_update in e.get("trip_update").get("stop_time_update", []):
-                            if stop_time_update.get("stop_id", "") in wanted_stop_ids:
+                            if stop_time_update.get("stop_id", "") in timetable.stop_ids:
                                 arrival_time = int((stop_time_update.get("arrival", stop_time_update.get("departure", {})).get("time", 0)))
                                 if arrival_time < int(time.time()):
                                     continue
                                 new_arrival = ArrivalTime(
-                                    stop_id = stop_time_update.get("stop_code"),
-                                    route_id = self.feed.routes[self.feed.routes["route_id"] == route_id]["route_short_name"].item(), 
-                                    destination = self.__lookup_headsign_by_route(route_id, direction_id), 
-                                    due_in_seconds = arrival_time - int(time.time()),
+                                    stop_id = timetable.stop_code_by_id[stop_time_update.get("stop_id")],
+                                    route_id = timetable.route_names[route_id], 
+                                    destination = timetable.lookup_headsign_by_route(route_id, direction_id), 
+                                    arrival_epoch = arrival_time,
                                     is_added = True
                                 )
                                 print("Added route:", new_arrival)
@@ -328,22 +228,171 @@ class GTFSClient:
                     print("Error parsing GTFS-R entry:", str(e))
                     raise x
                 
+            self.poll_scheduler.record_success()
             return deltas, canceled_trips, added_stops
         except Exception as e:
             print("Polling for GTFS-R failed:", str(e))
+            self.poll_scheduler.record_failure()
             return {}, [], []
 
 
-    def get_next_n_buses(self, num_entries: int) -> pd.core.frame.DataFrame:
+    def get_next_n_buses(self, num_entries: int) -> list[tuple[int, str, str]]:
+        """
+        Returns the next N buses arriving at the requested stops, as (arrival_time, trip_id, stop_id) tuples
+        sorted by arrival time. Arrival times are in seconds since today's midnight.
+        """
+        return self.timetable.next_departures(datetime.datetime.now(), num_entries)
+
+
+    def __check_for_feed_update(self) -> None:
+        """
+        Every feed_update_interval_seconds, start looking for a new version of the static feed
+        in the background. The current timetable keeps being used until the new one is ready.
+        """
+        if time.monotonic() < self._next_feed_check:
+            return
+        if self._feed_reload_thread and self._feed_reload_thread.is_alive():
+            return
+
+        self._next_feed_check = time.monotonic() + self._feed_update_interval_seconds
+        self._feed_reload_thread = threading.Thread(target=self.__reload_feed, name="feed-reload", daemon=True)
+        self._feed_reload_thread.start()
+
+
+    def __reload_feed(self) -> None:
+        """
+        Download the static feed if it changed, and swap in a timetable built from it
+        """
+        try:
+            with metrics.timed("feed_download"):
+                updated, new_mtime = refresh_feed.update_local_file_from_url_v2(self.feed_mtime, self.feed_name, self.feed_url)
+            if not updated:
+                return
+
+            # Compile the index of the new feed in a separate process, and wait for it to be written to disk.
+            # Parsing the feed needs far more memory than the compiled timetable, and this way all of it
+            # is given back to the OS before the new timetable is loaded next to the one in use.
+            print("Compiling the new feed", file=sys.stderr)
+            started = time.perf_counter()
+            process = multiprocessing.get_context("spawn").Process(
+                target=self.timetable_engine.Timetable.compile_index,
+                args=(self.feed_name, new_mtime, self.stop_codes, self.feed_load_workers, self.routes_for_stops))
+            if self._closed:
+                return
+            self._compile_process = process
+            try:
+                process.start()
+                process.join()
+            finally:
+                self._compile_process = None
+            metrics.observe("feed_compile", time.perf_counter() - started)
+            if process.exitcode != 0:
+                print("Compiling the new feed failed with exit code {}".format(process.exitcode), file=sys.stderr)
+                return
+
+            with metrics.timed("timetable_load"):
+                new_timetable = self.timetable_engine.Timetable.load(self.feed_name, new_mtime, self.stop_codes,
+                                                                     self.routes_for_stops, allow_compile=False)
+            if new_timetable is None:
+                print("The compiled timetable of the new feed could not be loaded", file=sys.stderr)
+                return
+
+            # Replacing the reference is atomic: a refresh in progress keeps using the old timetable
+            self.timetable = new_timetable
+            self.feed_mtime = new_mtime
+            del new_timetable
+            GTFSClient.__freeze_long_lived_objects()
+            print("Switched to the new timetable", file=sys.stderr)
+        except Exception as e:
+            print("Reloading the feed failed: {}".format(str(e)), file=sys.stderr)
+
+
+    def close(self) -> None:
+        """
+        Stop compiling a new feed, if that is in progress. Otherwise the program would wait for the
+        compiling process to finish when it exits, which can take minutes.
+        """
+        self._closed = True
+        process = self._compile_process
+        if process is None or not process.is_alive():
+            return
+
+        print("Stopping the compilation of the new feed", file=sys.stderr)
+        process.terminate()
+        process.join(COMPILE_STOP_TIMEOUT_SECONDS)
+        if process.is_alive():
+            # The stop signals are blocked in the server's processes (see server.py), so SIGTERM may not be enough
+            process.kill()
+            process.join()
+
+
+    def __publish(self, arrivals: list[ArrivalTime]) -> None:
         """
-        Returns a dataframe with the information of the next N buses arriving at the requested stops.
+        Enqueue new arrival times without ever blocking. If the display has fallen behind and
+        the queue is full, the oldest update is dropped: only the latest one matters.
         """
-        service_ids = self.__current_service_ids()
-        trip_ids = self.__trip_ids_for_service_ids(service_ids)
-        next_buses = self.__next_n_buses(trip_ids, num_entries)
-        joined_data = self.__join_data(next_buses)
-        self.__filter_routes_by_stops(joined_data)
-        return joined_data
+        while True:
+            try:
+                self._update_queue.put_nowait(arrivals)
+                metrics.set_gauge("update_queue_depth", self._update_queue.qsize())
+                return
+            except queue.Full:
+                try:
+                    self._update_queue.get_nowait()
+                    self.dropped_updates += 1
+                    metrics.set_gauge("dropped_updates", self.dropped_updates)
+                    print("Update queue is full, dropped a stale update ({} so far)".format(self.dropped_updates),
+                          file=sys.stderr)
+                except queue.Empty:
+                    pass
+
+
+    def arrivals_for(self, stop_codes: list[str] = None, routes_for_stops: dict[str, str] = None, 
+                     num_entries: int = 10) -> list[ArrivalTime]:
+        """
+        Returns the next arrivals at the given stops (by default all the stops this client was created for),
+        combining the timetable with the latest GTFS-R deltas, cancellations and added trips.
+        """
+        # Use the same timetable throughout, even if a new one is swapped in meanwhile
+        timetable = self.timetable
+        if routes_for_stops is None:
+            routes_for_stops = self.routes_for_stops
+        stop_ids = None if stop_codes is None else timetable.stop_ids_for_codes(stop_codes)
+
+        arrivals = []
+        # take more entries than we need in case there are cancellations
+        now = datetime.datetime.now()
+        # The timetable's arrival times are in seconds since midnight
+        midnight_epoch = int(now.timestamp()) - GTFSClient.__seconds_since_midnight(now)
+        with metrics.timed("next_buses"):
+            buses = timetable.next_departures(now, num_entries + 10, stop_ids, routes_for_stops)
+        
+        for arrival_time, trip_id, stop_id in buses:
+            if not trip_id in self.canceled_trips:
+                route_short_name, headsign, _ = timetable.trip_info[trip_id]
+                delta = self.deltas.get(trip_id, {}).get(stop_id, 0)
+                if delta != 0:
+                    print("Delta for route {} stop {} is {}".format(route_short_name, stop_id, delta))
+
+                arrival = ArrivalTime(stop_id = timetable.stop_code_by_id[stop_id], 
+                                    route_id = route_short_name,
+                                    destination = headsign,
+                                    arrival_epoch = midnight_epoch + arrival_time + delta,
+                                    is_added = False
+                )
+                arrivals.append(arrival)
+
+        added_stops = []
+        for added_stop in self.added_stops:
+            if stop_codes is not None and not added_stop.stop_id in stop_codes:
+                continue
+            routes = routes_for_stop(routes_for_stops, added_stop.stop_id)
+            if len(routes) == 0 or added_stop.route_id in routes:
+                added_stops.append(added_stop)
+
+        # Delays can reorder the scheduled arrivals, and the added stops from GTFS-R go in between them.
+        # Only the first num_entries are needed, so keep them in a heap instead of sorting everything
+        return heapq.nsmallest(num_entries, itertools.chain(arrivals, added_stops))
 
 
     def refresh(self):
@@ -351,43 +400,29 @@ class GTFSClient:
         Create and enqueue the refreshed stop data
         """
         try:
-            # Retrieve the GTFS-R deltas
-            deltas, canceled_trips, added_stops = self.__poll_gtfsr_deltas()
-            if len(deltas) > 0 or len(canceled_trips) > 0 or len(added_stops) > 0:
-                # Only update deltas and canceled trips if the API returns data
-                self.deltas = deltas
-                self.canceled_trips = canceled_trips
-                self.added_stops = added_stops
-
-            arrivals = []
-            # take more entries than we need in case there are cancellations
-            buses = self.get_next_n_buses(15) 
-            
-            for index, bus in buses.iterrows():
-                if not bus["trip_id"] in self.canceled_trips:
-                    delta = self.deltas.get(bus["trip_id"], {}).get(bus["stop_id"], 0)
-                    if delta != 0:
-                        print("Delta for route {} stop {} is {}".format(bus["route_short_name"], bus["stop_id"], delta))
-
-                    arrival = ArrivalTime(stop_id = bus["stop_code"], 
-                                        route_id = bus["route_short_name"],
-                                        destination = bus["trip_headsign"],
-                                        due_in_seconds = GTFSClient.__due_in_seconds(bus["arrival_time"]) + delta,
-                                        is_added = False
-                    )
-                    arrivals.append(arrival)
-
-            if len(self.added_stops) > 0:
-                # Append the added stops from GTFS-R and re-sort
-                arrivals.extend(self.added_stops)
-                arrivals.sort()
-
-            # Select the first 5 of what remains
-            arrivals = arrivals[0:5]
+            self.__check_for_feed_update()
+
+            # Retrieve the GTFS-R deltas, if it's time to
+            if self.poll_scheduler.is_due():
+                with metrics.timed("gtfsr_poll"):
+                    deltas, canceled_trips, added_stops = self.__poll_gtfsr_deltas(self.timetable)
+                if len(deltas) > 0 or len(canceled_trips) > 0 or len(added_stops) > 0:
+                    # Only update deltas and canceled trips if the API returns data
+                    self.deltas = deltas
+                    self.canceled_trips = canceled_trips
+                    self.added_stops = added_stops
+
+            # Select the first 10 arrivals. The display shows 5, the rest replace the buses
+            # that leave before the next refresh
+            arrivals = self.arrivals_for(num_entries=10)
+            self.poll_scheduler.schedule(arrivals[0].due_in_seconds if len(arrivals) > 0 else None)
+            metrics.set_gauge("gtfsr_poll_failures", self.poll_scheduler.failures)
 
             if self._update_queue:
-                self._update_queue.put(arrivals)
+                self.__publish(arrivals)
 
-            gc.collect()
+            if self.snapshot_file and time.monotonic() >= self._next_snapshot:
+                arrivals_snapshot.save(self.snapshot_file, arrivals, self.deltas, self.canceled_trips, self.added_stops)
+                self._next_snapshot = time.monotonic() + SNAPSHOT_INTERVAL_SECONDS
         except Exception as e:
             print("Exception in refresh: {}".format(str(e)))
@@ -0,0 +1,264 @@
+# Streaming parser for GTFS-Realtime TripUpdates feeds
+# The national TripUpdates feed is many megabytes, but only a handful of its entities are relevant
+# to the stops we display. Instead of downloading the whole feed and decoding it into one big tree,
+# the protobuf encoding is read from the network one entity at a time. The trip descriptor of each
+# entity is peeked at first, and only the entities the caller wants are decoded.
+#
+# Decoded entities have the same shape as the JSON encoding of the feed (field names as in
+# gtfs-realtime.proto, enums as their names), so the rest of the code does not need to care which
+# encoding the feed was downloaded in.
+#
+# Only the fields of gtfs-realtime.proto that we use are decoded, so no protobuf library is needed.
+
+import json
+
+# Protobuf wire types
+WIRE_VARINT = 0
+WIRE_FIXED64 = 1
+WIRE_LENGTH_DELIMITED = 2
+WIRE_FIXED32 = 5
+
+# Field numbers from gtfs-realtime.proto
+FEED_MESSAGE_ENTITY = 2
+FEED_ENTITY_ID = 1
+FEED_ENTITY_IS_DELETED = 2
+FEED_ENTITY_TRIP_UPDATE = 3
+TRIP_UPDATE_TRIP = 1
+TRIP_UPDATE_STOP_TIME_UPDATE = 2
+TRIP_UPDATE_TIMESTAMP = 4
+TRIP_UPDATE_DELAY = 5
+TRIP_TRIP_ID = 1
+TRIP_START_TIME = 2
+TRIP_START_DATE = 3
+TRIP_SCHEDULE_RELATIONSHIP = 4
+TRIP_ROUTE_ID = 5
+TRIP_DIRECTION_ID = 6
+STOP_TIME_UPDATE_STOP_SEQUENCE = 1
+STOP_TIME_UPDATE_ARRIVAL = 2
+STOP_TIME_UPDATE_DEPARTURE = 3
+STOP_TIME_UPDATE_STOP_ID = 4
+STOP_TIME_UPDATE_SCHEDULE_RELATIONSHIP = 5
+STOP_TIME_EVENT_DELAY = 1
+STOP_TIME_EVENT_TIME = 2
+STOP_TIME_EVENT_UNCERTAINTY = 3
+
+TRIP_SCHEDULE_RELATIONSHIPS = {0: "SCHEDULED", 1: "ADDED", 2: "UNSCHEDULED", 3: "CANCELED",
+                               5: "REPLACEMENT", 6: "DUPLICATED", 7: "DELETED"}
+STOP_SCHEDULE_RELATIONSHIPS = {0: "SCHEDULED", 1: "SKIPPED", 2: "NO_DATA", 3: "UNSCHEDULED"}
+
+
+def _decode_varint(buf, pos: int) -> tuple[int, int]:
+    """ Decode a varint from buf starting at pos. Returns the value and the position after it """
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _to_signed(value: int) -> int:
+    """ Negative int32/int64 values are encoded as 64-bit two's complement varints """
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def _iter_fields(buf):
+    """ Yields (field_number, wire_type, value) for each field of an encoded message """
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        key, pos = _decode_varint(buf, pos)
+        field_number = key >> 3
+        wire_type = key & 7
+        if wire_type == WIRE_VARINT:
+            value, pos = _decode_varint(buf, pos)
+        elif wire_type == WIRE_LENGTH_DELIMITED:
+            length, pos = _decode_varint(buf, pos)
+            value = buf[pos:pos + length]
+            pos += length
+        elif wire_type == WIRE_FIXED64:
+            value = int.from_bytes(buf[pos:pos + 8], "little")
+            pos += 8
+        elif wire_type == WIRE_FIXED32:
+            value = int.from_bytes(buf[pos:pos + 4], "little")
+            pos += 4
+        else:
+            raise ValueError("Unsupported protobuf wire type {}".format(wire_type))
+        yield field_number, wire_type, value
+
+
+def _decode_trip(buf) -> dict:
+    trip = {"schedule_relationship": TRIP_SCHEDULE_RELATIONSHIPS[0]}
+    for field_number, _, value in _iter_fields(buf):
+        if field_number == TRIP_TRIP_ID:
+            trip["trip_id"] = str(value, "utf-8")
+        elif field_number == TRIP_START_TIME:
+            trip["start_time"] = str(value, "utf-8")
+        elif field_number == TRIP_START_DATE:
+            trip["start_date"] = str(value, "utf-8")
+        elif field_number == TRIP_SCHEDULE_RELATIONSHIP:
+            trip["schedule_relationship"] = TRIP_SCHEDULE_RELATIONSHIPS.get(value, str(value))
+        elif field_number == TRIP_ROUTE_ID:
+            trip["route_id"] = str(value, "utf-8")
+        elif field_number == TRIP_DIRECTION_ID:
+            trip["direction_id"] = value
+    return trip
+
+
+def _decode_stop_time_event(buf) -> dict:
+    event = {}
+    for field_number, _, value in _iter_fields(buf):
+        if field_number == STOP_TIME_EVENT_DELAY:
+            event["delay"] = _to_signed(value)
+        elif field_number == STOP_TIME_EVENT_TIME:
+            event["time"] = _to_signed(value)
+        elif field_number == STOP_TIME_EVENT_UNCERTAINTY:
+            event["uncertainty"] = _to_signed(value)
+    return event
+
+
+def _decode_stop_time_update(buf) -> dict:
+    update = {}
+    for field_number, _, value in _iter_fields(buf):
+        if field_number == STOP_TIME_UPDATE_STOP_SEQUENCE:
+            update["stop_sequence"] = value
+        elif field_number == STOP_TIME_UPDATE_ARRIVAL:
+            update["arrival"] = _decode_stop_time_event(value)
+        elif field_number == STOP_TIME_UPDATE_DEPARTURE:
+            update["departure"] = _decode_stop_time_event(value)
+        elif field_number == STOP_TIME_UPDATE_STOP_ID:
+            update["stop_id"] = str(value, "utf-8")
+        elif field_number == STOP_TIME_UPDATE_SCHEDULE_RELATIONSHIP:
+            update["schedule_relationship"] = STOP_SCHEDULE_RELATIONSHIPS.get(value, str(value))
+    return update
+
+
+def _decode_trip_update(buf) -> dict:
+    trip_update = {"stop_time_update": []}
+    for field_number, _, value in _iter_fields(buf):
+        if field_number == TRIP_UPDATE_TRIP:
+            trip_update["trip"] = _decode_trip(value)
+        elif field_number == TRIP_UPDATE_STOP_TIME_UPDATE:
+            trip_update["stop_time_update"].append(_decode_stop_time_update(value))
+        elif field_number == TRIP_UPDATE_TIMESTAMP:
+            trip_update["timestamp"] = value
+        elif field_number == TRIP_UPDATE_DELAY:
+            trip_update["delay"] = _to_signed(value)
+    return trip_update
+
+
+def _peek_trip(entity_buf) -> dict:
+    """
+    Decode only the trip descriptor of an encoded FeedEntity, without decoding its stop time updates.
+    Returns None if the entity is not a trip update.
+    """
+    for field_number, _, value in _iter_fields(entity_buf):
+        if field_number == FEED_ENTITY_TRIP_UPDATE:
+            for trip_update_field, _, trip_value in _iter_fields(value):
+                if trip_update_field == TRIP_UPDATE_TRIP:
+                    return _decode_trip(trip_value)
+            return {}
+    return None
+
+
+def _decode_entity(entity_buf) -> dict:
+    entity = {}
+    for field_number, _, value in _iter_fields(entity_buf):
+        if field_number == FEED_ENTITY_ID:
+            entity["id"] = str(value, "utf-8")
+        elif field_number == FEED_ENTITY_IS_DELETED:
+            entity["is_deleted"] = bool(value)
+        elif field_number == FEED_ENTITY_TRIP_UPDATE:
+            entity["trip_update"] = _decode_trip_update(value)
+    return entity
+
+
+class _ChunkReader:
+    """ Reads exact numbers of bytes from an iterable of byte chunks, such as requests' iter_content() """
+
+    def __init__(self, chunks) -> None:
+        self._chunks = iter(chunks)
+        self._buffer = b""
+        self._pos = 0
+
+    def read(self, length: int) -> bytes:
+        while len(self._buffer) - self._pos < length:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer = self._buffer[self._pos:] + chunk
+            self._pos = 0
+
+        data = self._buffer[self._pos:self._pos + length]
+        self._pos += len(data)
+        return data
+
+    def read_varint(self) -> int:
+        """ Read a varint. Returns None at the end of the stream """
+        result = 0
+        shift = 0
+        while True:
+            b = self.read(1)
+            if not b:
+                if shift == 0:
+                    return None
+                raise EOFError("Truncated GTFS-R feed")
+            result |= (b[0] & 0x7f) << shift
+            if b[0] < 0x80:
+                return result
+            shift += 7
+
+    def read_exactly(self, length: int) -> bytes:
+        data = self.read(length)
+        if len(data) != length:
+            raise EOFError("Truncated GTFS-R feed")
+        return data
+
+
+def iter_trip_updates_protobuf(chunks, wants_trip) -> iter:
+    """
+    Reads a protobuf-encoded FeedMessage from an iterable of byte chunks, one entity at a time.
+    wants_trip is called with the decoded trip descriptor of each trip update, and only the
+    entities for which it returns True are fully decoded and yielded.
+    """
+    reader = _ChunkReader(chunks)
+    while True:
+        key = reader.read_varint()
+        if key is None:
+            return
+        field_number = key >> 3
+        wire_type = key & 7
+        if wire_type == WIRE_VARINT:
+            reader.read_varint()
+            continue
+        elif wire_type == WIRE_FIXED64:
+            reader.read_exactly(8)
+            continue
+        elif wire_type == WIRE_FIXED32:
+            reader.read_exactly(4)
+            continue
+        elif wire_type != WIRE_LENGTH_DELIMITED:
+            raise ValueError("Unsupported protobuf wire type {}".format(wire_type))
+
+        data = memoryview(reader.read_exactly(reader.read_varint()))
+        if field_number != FEED_MESSAGE_ENTITY:
+            # The feed header
+            continue
+
+        trip = _peek_trip(data)
+        if trip is not None and wants_trip(trip):
+            yield _decode_entity(data)
+
+
+def iter_trip_updates_json(stream, wants_trip) -> iter:
+    """
+    Reads a JSON-encoded FeedMessage from a stream and yields the trip update entities
+    for which wants_trip returns True. Unlike the protobuf parser, the whole document is decoded at once.
+    """
+    for e in json.load(stream).get("entity", []):
+        trip_update = e.get("trip_update")
+        if trip_update is not None and wants_trip(trip_update.get("trip", {})):
+            yield e
@@ -0,0 +1,232 @@
+# Timetable engine without pandas
+# On a Raspberry Pi Zero W, pandas, numpy and gtfs_kit alone take a large share of the RAM, although
+# each refresh only asks for the next few departures at a handful of stops. This engine reads the CSV files
+# of the zip with the csv module and keeps the timetable in plain containers: the departures in array
+# columns sorted by arrival time, and the trips in small slotted records. It answers exactly like the
+# pandas engine in timetable.py (benchmarks/bench.py checks that), and it is selected with
+# timetable-engine: lite in config.yaml. Nothing here may import pandas.
+
+from array import array
+import csv
+import datetime
+from departures import ServiceDayDepartures
+import io
+import metrics
+import os
+from service_calendar import ServiceCalendar, WEEKDAYS
+import stop_times_filter
+import sys
+from timetable_base import BaseTimetable, trip_ids_by_stop
+import zipfile
+
+class Trip:
+    """ A trip that calls at one of our stops """
+    __slots__ = ("route_id", "service_id", "headsign", "direction_id")
+
+    def __init__(self, route_id: str, service_id: str, headsign: str, direction_id: int) -> None:
+        self.route_id = route_id
+        self.service_id = service_id
+        self.headsign = headsign
+        self.direction_id = direction_id
+
+    def __getstate__(self):
+        return (self.route_id, self.service_id, self.headsign, self.direction_id)
+
+    def __setstate__(self, state) -> None:
+        self.route_id, self.service_id, self.headsign, self.direction_id = state
+
+
+class Timetable(BaseTimetable):
+    """
+    The part of the static GTFS feed that serves the configured stops, with the same lookups and queries
+    as timetable.Timetable. Once built its contents never change.
+    """
+
+    INDEX_SUFFIX = ".lite.idx"
+
+    def __init__(self, tables: dict, stop_codes: list[str], routes_for_stops: dict[str, str]):
+        super().__init__(stop_codes, routes_for_stops)
+
+        # Departures sorted by arrival time. Trips and stops are stored as indexes into trip_ids and stop_id_list
+        self._arrival_times = tables["arrival_times"]
+        self._trip_indexes = tables["trip_indexes"]
+        self._stop_indexes = tables["stop_indexes"]
+        self._trip_ids = tables["trip_ids"]
+        self._stop_id_list = tables["stop_ids"]
+        self.trips = tables["trips"]
+
+        with metrics.timed("service_calendar"):
+            self.service_calendar = ServiceCalendar(tables["calendar"], tables["calendar_dates"])
+
+        self.stop_code_by_id = tables["stop_code_by_id"]
+        stop_codes = set(str(stop_code) for stop_code in stop_codes)
+        self.stop_ids = frozenset(stop_id for stop_id, stop_code in self.stop_code_by_id.items() if stop_code in stop_codes)
+        if not self.stop_ids:
+            raise Exception("Stops is empty!")
+        self.__build_lookups(tables["route_names"])
+
+    @staticmethod
+    def compile_feed(path: str, stop_codes: list[str], workers: int = 1, routes_for_stops: dict = None) -> dict:
+        """
+        Reads the rows of the feed that serve the configured stops, straight from the zip file.
+        stop_times.txt is filtered by scanning its raw bytes, as in the pandas engine (with a pool of
+        worker processes if there's more than one worker), and the other tables are pruned to the trips,
+        routes and calendars of the stop_times that are left. At the stops that only show some routes
+        (routes_for_stops), only the stop_times of those routes are kept.
+        """
+        if not os.path.exists(path):
+            raise ValueError("Path {} does not exist".format(path))
+
+        print("Loading GTFS feed {}".format(path), file=sys.stderr)
+
+        with zipfile.ZipFile(path) as z:
+            wanted_codes = set(str(stop_code) for stop_code in stop_codes)
+            stop_code_by_id = {stop_id: stop_code
+                               for stop_id, stop_code in Timetable.__read_table(z, "stops.txt", ["stop_id", "stop_code"])
+                               if stop_code in wanted_codes}
+
+            # routes.txt is small, but trips.txt is not: it is streamed again below rather than kept in memory
+            all_route_names = dict(Timetable.__read_table(z, "routes.txt", ["route_id", "route_short_name"]))
+            trip_ids_for_stops = {}
+            if routes_for_stops:
+                trip_ids_for_stops = trip_ids_by_stop(stop_code_by_id, all_route_names,
+                                                      Timetable.__read_table(z, "trips.txt", ["trip_id", "route_id"]),
+                                                      routes_for_stops)
+
+            with z.open("stop_times.txt") as f, metrics.timed("read_feed_table", table="stop_times"):
+                lines = stop_times_filter.filter_file(f, frozenset(stop_code_by_id.keys()), workers, trip_ids_for_stops)
+                departures = Timetable.__parse_stop_times(lines)
+                del lines
+
+            # Keep the trips in the order of trips.txt, like the pandas engine
+            trip_ids_served = set(trip_id for _, trip_id, _ in departures)
+            trips = {}
+            for trip_id, route_id, service_id, headsign, direction_id in Timetable.__read_table(
+                    z, "trips.txt", ["trip_id", "route_id", "service_id", "trip_headsign", "direction_id"]):
+                if trip_id in trip_ids_served:
+                    direction_id = int(direction_id) if direction_id.strip() else None
+                    trips[trip_id] = Trip(route_id, service_id, headsign, direction_id)
+
+            route_ids = set(trip.route_id for trip in trips.values())
+            route_names = {route_id: short_name for route_id, short_name in all_route_names.items() if route_id in route_ids}
+
+            service_ids = set(trip.service_id for trip in trips.values())
+            calendar = [(row[0], row[1], row[2], tuple(flag.strip() == "1" for flag in row[3:]))
+                        for row in Timetable.__read_table(z, "calendar.txt", ["service_id", "start_date", "end_date"] + WEEKDAYS)
+                        if row[0] in service_ids]
+            calendar_dates = [(service_id, date, int(exception_type) if exception_type.strip() else 0)
+                              for service_id, date, exception_type
+                              in Timetable.__read_table(z, "calendar_dates.txt", ["service_id", "date", "exception_type"])
+                              if service_id in service_ids]
+
+        # Number the trips and stops, so that each departure is stored as three integers
+        trip_ids = list(trips.keys())
+        trip_index_by_id = {trip_id: i for i, trip_id in enumerate(trip_ids)}
+        stop_ids = sorted(set(stop_id for _, _, stop_id in departures))
+        stop_index_by_id = {stop_id: i for i, stop_id in enumerate(stop_ids)}
+
+        return {
+            "arrival_times": array("i", (arrival_time for arrival_time, _, _ in departures)),
+            "trip_indexes": array("I", (trip_index_by_id[trip_id] for _, trip_id, _ in departures)),
+            "stop_indexes": array("I", (stop_index_by_id[stop_id] for _, _, stop_id in departures)),
+            "trip_ids": trip_ids,
+            "stop_ids": stop_ids,
+            "trips": trips,
+            "route_names": route_names,
+            # Only the stops that have departures, like the pruned stops table of the pandas engine
+            "stop_code_by_id": {stop_id: stop_code_by_id[stop_id] for stop_id in stop_ids},
+            "calendar": calendar,
+            "calendar_dates": calendar_dates,
+        }
+
+
+    @staticmethod
+    def __read_table(z: zipfile.ZipFile, filename: str, columns: list[str]) -> iter:
+        """
+        Yields the given columns of each row of a table of the feed, as tuples of strings, as the rows are read,
+        so that the callers keep only the rows they need. Missing columns and missing files read as empty strings
+        and no rows respectively.
+        """
+        table = filename.split(".")[0]
+        if not filename in z.namelist():
+            return
+        with z.open(filename) as f, metrics.timed("read_feed_table", table=table):
+            reader = csv.reader(io.TextIOWrapper(f, encoding="utf-8-sig", newline=""))
+            header = [column.strip() for column in next(reader, [])]
+            positions = [header.index(column) if column in header else None for column in columns]
+            for row in reader:
+                if not row:
+                    continue
+                yield tuple(row[i] if i is not None and i < len(row) else "" for i in positions)
+
+
+    @staticmethod
+    def __parse_stop_times(lines: bytes) -> list[tuple[int, str, str]]:
+        """
+        Parses the filtered lines of stop_times.txt into (arrival_time, trip_id, stop_id) tuples, sorted by arrival time.
+        Times are in seconds since the start of the service day. Either time may be left empty for stops that
+        are not timepoints, and the other one is used then. Rows with neither are dropped.
+        """
+        reader = csv.reader(io.StringIO(lines.decode("utf-8-sig"), newline=""))
+        header = [column.strip() for column in next(reader, [])]
+        if not header:
+            return []
+        trip_id_column = header.index("trip_id")
+        arrival_column = header.index("arrival_time")
+        departure_column = header.index("departure_time")
+        stop_id_column = header.index("stop_id")
+
+        departures = []
+        for row in reader:
+            if not row:
+                continue
+            arrival_time = Timetable.__time_to_seconds(row[arrival_column])
+            if arrival_time is None:
+                arrival_time = Timetable.__time_to_seconds(row[departure_column])
+                if arrival_time is None:
+                    continue
+            departures.append((arrival_time, row[trip_id_column], row[stop_id_column]))
+
+        # Sorting is stable, so departures at the same time stay in the order of the file
+        departures.sort(key=lambda departure: departure[0])
+        return departures
+
+
+    @staticmethod
+    def __time_to_seconds(s: str) -> int:
+        """ Converts a GTFS HH:MM:SS time into seconds since the start of the service day. Returns None if it's not valid """
+        parts = s.strip().split(":")
+        if len(parts) != 3 or not all(part.isdigit() for part in parts) or len(parts[1]) != 2 or len(parts[2]) != 2:
+            return None
+        return int(parts[0]) * 3600 + int(parts[1]) * 60 + int(parts[2])
+
+
+    def _departures_for_day(self, day: datetime.date) -> ServiceDayDepartures:
+        with metrics.timed("active_service_ids"):
+            service_ids = self.service_calendar.active_service_ids(day)
+        trip_ids = self._trip_ids
+        active_trips = [self.trips[trip_id].service_id in service_ids for trip_id in trip_ids]
+        if not any(active_trips):
+            print("There are no active trips!")
+
+        stop_ids = self._stop_id_list
+        indexes = [i for i, trip_index in enumerate(self._trip_indexes) if active_trips[trip_index]]
+        return ServiceDayDepartures((self._arrival_times[i] for i in indexes),
+                                    (trip_ids[self._trip_indexes[i]] for i in indexes),
+                                    (stop_ids[self._stop_indexes[i]] for i in indexes))
+
+
+    def __build_lookups(self, route_names: dict[str, str]) -> None:
+        """ The same lookups as timetable.Timetable, from the trip records """
+        self.route_names = route_names
+        # trip_id -> (route_short_name, trip_headsign, direction_id)
+        self.trip_info = {}
+        # (route_id, direction_id) -> trip_headsign, used for trips added by GTFS-R
+        self.headsign_by_route_direction = {}
+        for trip_id, trip in self.trips.items():
+            self.trip_info[trip_id] = (route_names.get(trip.route_id), trip.headsign, trip.direction_id)
+            if trip.headsign:
+                self.headsign_by_route_direction.setdefault((trip.route_id, trip.direction_id), trip.headsign)
+
+        # The trips that call at our stops. GTFS-R updates for any other trip are ignored
+        self.relevant_trip_ids = frozenset(self.trip_info.keys())
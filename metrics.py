@@ -0,0 +1,184 @@
+# Timing and memory instrumentation
+# The slow parts of the program (downloads, loading the feed, polling GTFS-R, rendering) time themselves
+# with timed(), and a few gauges (queue depth, dropped updates) are set where they change.
+# Together with the RSS and the time spent in garbage collection, they are exposed in the
+# Prometheus text format, either on an HTTP endpoint (/metrics) or in a file that is replaced
+# atomically, for node_exporter's textfile collector or any other scraper.
+
+import atomic_file
+import contextlib
+import gc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import resource
+import sys
+import threading
+import time
+
+PREFIX = "dublinbus_"
+
+_lock = threading.Lock()
+# (phase, labels) -> [count, total seconds, last seconds, max seconds]
+_phases = {}
+# (name, labels) -> value
+_gauges = {}
+_gc_pauses = {"count": 0, "seconds": 0.0, "max_seconds": 0.0}
+_gc_started = None
+
+
+def _key(name: str, labels: dict) -> tuple:
+    return name, tuple(sorted((labels or {}).items()))
+
+
+def observe(phase: str, seconds: float, **labels) -> None:
+    """ Record that a phase of the program took the given number of seconds """
+    key = _key(phase, labels)
+    with _lock:
+        stats = _phases.get(key)
+        if stats is None:
+            stats = _phases[key] = [0, 0.0, 0.0, 0.0]
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] = seconds
+        stats[3] = max(stats[3], seconds)
+
+
+@contextlib.contextmanager
+def timed(phase: str, **labels):
+    """ Time the body of a with statement as a phase of the program """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(phase, time.perf_counter() - started, **labels)
+
+
+def set_gauge(name: str, value: float, **labels) -> None:
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def _gc_callback(phase: str, info: dict) -> None:
+    global _gc_started
+    if phase == "start":
+        _gc_started = time.perf_counter()
+    elif _gc_started is not None:
+        pause = time.perf_counter() - _gc_started
+        _gc_started = None
+        _gc_pauses["count"] += 1
+        _gc_pauses["seconds"] += pause
+        _gc_pauses["max_seconds"] = max(_gc_pauses["max_seconds"], pause)
+
+
+def rss_bytes() -> int:
+    """ Current resident set size. Falls back to the peak RSS where /proc is not available """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return peak_rss_bytes()
+
+
+def peak_rss_bytes() -> int:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux reports KB
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def _format_labels(labels: tuple, **extra) -> str:
+    items = list(extra.items()) + list(labels)
+    if not items:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in items) + "}"
+
+
+def render() -> str:
+    """ Returns all the metrics in the Prometheus text exposition format """
+    lines = []
+    with _lock:
+        phases = {key: list(stats) for key, stats in _phases.items()}
+        gauges = dict(_gauges)
+        gc_pauses = dict(_gc_pauses)
+
+    lines.append("# HELP {}phase_seconds Time spent in each phase of the program".format(PREFIX))
+    lines.append("# TYPE {}phase_seconds summary".format(PREFIX))
+    for (phase, labels), (count, total, _, _) in sorted(phases.items()):
+        lines.append("{}phase_seconds_count{} {}".format(PREFIX, _format_labels(labels, phase=phase), count))
+        lines.append("{}phase_seconds_sum{} {:.6f}".format(PREFIX, _format_labels(labels, phase=phase), total))
+    lines.append("# HELP {}phase_last_seconds Duration of the last run of each phase".format(PREFIX))
+    lines.append("# TYPE {}phase_last_seconds gauge".format(PREFIX))
+    for (phase, labels), (_, _, last, _) in sorted(phases.items()):
+        lines.append("{}phase_last_seconds{} {:.6f}".format(PREFIX, _format_labels(labels, phase=phase), last))
+    lines.append("# HELP {}phase_max_seconds Longest run of each phase".format(PREFIX))
+    lines.append("# TYPE {}phase_max_seconds gauge".format(PREFIX))
+    for (phase, labels), (_, _, _, longest) in sorted(phases.items()):
+        lines.append("{}phase_max_seconds{} {:.6f}".format(PREFIX, _format_labels(labels, phase=phase), longest))
+
+    for (name, labels), value in sorted(gauges.items()):
+        if not "# TYPE {}{} gauge".format(PREFIX, name) in lines:
+            lines.append("# TYPE {}{} gauge".format(PREFIX, name))
+        lines.append("{}{}{} {}".format(PREFIX, name, _format_labels(labels), value))
+
+    lines.append("# TYPE {}gc_pauses_total counter".format(PREFIX))
+    lines.append("{}gc_pauses_total {}".format(PREFIX, gc_pauses["count"]))
+    lines.append("# TYPE {}gc_pause_seconds_total counter".format(PREFIX))
+    lines.append("{}gc_pause_seconds_total {:.6f}".format(PREFIX, gc_pauses["seconds"]))
+    lines.append("# TYPE {}gc_pause_max_seconds gauge".format(PREFIX))
+    lines.append("{}gc_pause_max_seconds {:.6f}".format(PREFIX, gc_pauses["max_seconds"]))
+    lines.append("# TYPE {}resident_memory_bytes gauge".format(PREFIX))
+    lines.append("{}resident_memory_bytes {}".format(PREFIX, rss_bytes()))
+    lines.append("# TYPE {}peak_resident_memory_bytes gauge".format(PREFIX))
+    lines.append("{}peak_resident_memory_bytes {}".format(PREFIX, peak_rss_bytes()))
+    return "\n".join(lines) + "\n"
+
+
+def write_file(path: str) -> None:
+    """ Write the metrics to a file. It is written under a temporary name and renamed, so scrapers never see half of it """
+    try:
+        with atomic_file.replace_file(path) as f:
+            f.write(render())
+    except Exception as e:
+        print("Could not write the metrics to {}: {}".format(path, str(e)), file=sys.stderr)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start(port: int = None, path: str = None, file_interval_seconds: int = 60) -> None:
+    """
+    Start collecting the GC pauses, and exposing the metrics on http://<host>:<port>/metrics
+    and/or in a file rewritten every file_interval_seconds. With neither, nothing is exposed.
+    """
+    if not _gc_callback in gc.callbacks:
+        gc.callbacks.append(_gc_callback)
+
+    if port:
+        # The metrics are optional: if the port is taken, carry on without them
+        try:
+            server = ThreadingHTTPServer(("", port), _MetricsHandler)
+        except OSError as e:
+            print("Could not serve metrics on port {}: {}".format(port, str(e)), file=sys.stderr)
+        else:
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+            print("Serving metrics on port {}".format(port), file=sys.stderr)
+
+    if path:
+        def write_periodically():
+            while True:
+                write_file(path)
+                time.sleep(file_interval_seconds)
+        threading.Thread(target=write_periodically, name="metrics-file", daemon=True).start()
@@ -0,0 +1,107 @@
+import email.utils
+import random
+import sys
+import time
+from collections import deque
+
+# Poll at the fastest rate when a bus is due within this many seconds. Further away than this,
+# the predictions are unlikely to change what's on the screen, so polls are spaced out
+SOON_SECONDS = 30 * 60
+
+# Longest wait after consecutive failures, before the jitter
+MAX_BACKOFF_SECONDS = 30 * 60
+
+# A poll is due this many seconds before its planned time, so that a poll planned for the next
+# refresh is not missed because the refresh started a moment early
+POLL_TOLERANCE_SECONDS = 5
+
+# The request budget is counted over this window
+BUDGET_WINDOW_SECONDS = 24 * 3600
+
+
+def parse_retry_after(value: str) -> float:
+    """ Parse a Retry-After header, either a number of seconds or an HTTP date. Returns None if it's not valid """
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(0.0, email.utils.mktime_tz(parsed) - time.time())
+
+
+class PollScheduler:
+    """
+    Decides when to poll the GTFS-R API. Polls are as frequent as allowed while a bus is due soon,
+    and spaced out up to max_interval_seconds when the next bus is far away (e.g. overnight).
+    Failures back off exponentially with jitter, a Retry-After from the server is honored,
+    and no more than daily_budget requests are made in any 24 hours.
+    """
+
+    def __init__(self, min_interval_seconds: float, max_interval_seconds: float, daily_budget: int = None) -> None:
+        self.min_interval_seconds = min_interval_seconds
+        self.max_interval_seconds = max(min_interval_seconds, max_interval_seconds)
+        self.daily_budget = daily_budget
+        self.failures = 0
+        self._last_poll = None
+        self._next_poll = 0.0
+        self._not_before = 0.0
+        self._requests = deque()
+        self._budget_warned = False
+
+    def is_due(self) -> bool:
+        """ Whether a poll should be made now """
+        now = time.monotonic()
+        if now + POLL_TOLERANCE_SECONDS < self._next_poll or now < self._not_before:
+            return False
+        if not self.__budget_allows(now):
+            if not self._budget_warned:
+                print("GTFS-R request budget of {} per day used up, waiting".format(self.daily_budget), file=sys.stderr)
+                self._budget_warned = True
+            return False
+        self._budget_warned = False
+        return True
+
+    def record_request(self) -> None:
+        """ Count a request against the budget. Call it right before each request """
+        now = time.monotonic()
+        self._last_poll = now
+        self._requests.append(now)
+
+    def record_success(self) -> None:
+        self.failures = 0
+
+    def record_failure(self, retry_after_seconds: float = None) -> None:
+        """ Back off after a failed poll: exponentially with jitter, but never earlier than the server asked for """
+        self.failures += 1
+        backoff = min(MAX_BACKOFF_SECONDS, self.min_interval_seconds * 2 ** (self.failures - 1))
+        # Spread the retries of many displays that failed at the same time
+        delay = random.uniform(backoff / 2, backoff)
+        if retry_after_seconds is not None:
+            delay = max(delay, retry_after_seconds)
+        self._not_before = time.monotonic() + delay
+        print("GTFS-R poll failed {} time(s) in a row, retrying in {:.0f}s".format(self.failures, delay), file=sys.stderr)
+
+    def schedule(self, next_arrival_seconds: float) -> None:
+        """
+        Plan the next poll from the time until the next bus at our stops (None if there isn't any).
+        It can be called on every refresh: the wait shrinks as the next bus gets closer.
+        """
+        if self._last_poll is None:
+            return
+        self._next_poll = self._last_poll + self.interval_seconds(next_arrival_seconds)
+
+    def interval_seconds(self, next_arrival_seconds: float) -> float:
+        """ Time between polls while the next bus is due in the given number of seconds """
+        if next_arrival_seconds is None:
+            return self.max_interval_seconds
+        return min(self.max_interval_seconds, max(self.min_interval_seconds, next_arrival_seconds - SOON_SECONDS))
+
+    def __budget_allows(self, now: float) -> bool:
+        if not self.daily_budget:
+            return True
+        while self._requests and self._requests[0] <= now - BUDGET_WINDOW_SECONDS:
+            self._requests.popleft()
+        return len(self._requests) < self.daily_budget
@@ -2,12 +2,14 @@
 # Only download the file if the source is newer than the local copy
 # This code was adapted from https://forums.raspberrypi.com/viewtopic.php?t=152226#p998268
 
+import atomic_file
 import email.utils
+import json
 import os
 import sys
 import time
 import requests
-import urllib3
+import zipfile
 
 # First we construct a handful of functions - testing happens down at the end
 def httpdate_to_ts(dt):
@@ -18,58 +20,130 @@ def httpdate_to_ts(dt):
 def ts_to_httpdate(ts):
     return email.utils.formatdate(timeval=ts, localtime=False, usegmt=True)
 
-# v1: download remote file if HTTP's Last-Modified header indicates that
-#     the file has been updated. This requires the remote server to support
-#     sending the Last-Modified header.
+# v2: download the remote file with a single conditional GET over a reused connection pool.
+#     The ETag and Last-Modified headers of the last download are kept in a small sidecar
+#     file and sent back as If-None-Match / If-Modified-Since, so the server only sends the
+#     file when it has changed. The file is downloaded under a temporary name, checked to be
+#     a complete zip file, and then renamed over the local file, so an interrupted download
+#     never replaces a good feed. An interrupted download is resumed with a Range request.
 #
-def update_local_file_from_url_v1(last_mtime, local_file, url):
-
-    # Check the status of the remote file without downloading it
-    r1 = requests.head(url)
-    if r1.status_code != requests.codes.ok:
-        # http request failed
-        print('HEY! get for {} returned {}'.format(url, r1.status_code),
-              file=sys.stderr)
-        return False, last_mtime
+_session = None
+
+# Files that a GTFS zip must contain to be usable
+REQUIRED_FEED_FILES = ['stops.txt', 'routes.txt', 'trips.txt', 'stop_times.txt']
+
+
+def _get_session():
+    global _session
+    if _session is None:
+        _session = requests.Session()
+    return _session
+
+
+def _read_metadata(metadata_file):
+    try:
+        with open(metadata_file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_metadata(metadata_file, metadata):
+    with atomic_file.replace_file(metadata_file) as f:
+        json.dump(metadata, f)
+
+
+def _is_complete_zip(path):
+    """ Check that the zip's central directory can be read and lists the files we need """
+    try:
+        with zipfile.ZipFile(path) as z:
+            names = set(z.namelist())
+        return all(name in names for name in REQUIRED_FEED_FILES)
+    except (OSError, zipfile.BadZipFile):
+        return False
+
+
+def update_local_file_from_url_v2(last_mtime, local_file, url):
+    metadata_file = local_file + '.meta'
+    partial_file = local_file + '.part'
+    metadata = _read_metadata(metadata_file)
 
-    # Get the modification time for the file, if possible
-    if 'Last-Modified' in r1.headers:
-        mtime = httpdate_to_ts(r1.headers['Last-Modified'])
+    headers = {'Accept-Encoding': 'identity'}
+    if os.path.exists(local_file):
+        # Only send the file if it changed since we downloaded it
+        if metadata.get('etag'):
+            headers['If-None-Match'] = metadata['etag']
+        if last_mtime:
+            headers['If-Modified-Since'] = ts_to_httpdate(last_mtime)
+
+    # Resume an interrupted download, as long as the remote file is still the same one
+    resume_from = os.path.getsize(partial_file) if os.path.exists(partial_file) else 0
+    partial_validator = metadata.get('partial_etag') or metadata.get('partial_last_modified')
+    if resume_from and partial_validator:
+        headers['Range'] = 'bytes={}-'.format(resume_from)
+        headers['If-Range'] = partial_validator
     else:
-        print('HEY! no Last-Modified header for {}'.format(url),
-              file=sys.stderr)
+        resume_from = 0
+
+    try:
+        with _get_session().get(url, headers=headers, stream=True, timeout=(10, 60)) as r:
+            if r.status_code == requests.codes.not_modified:
+                print('No need to refresh feed.', file=sys.stderr)
+                return False, last_mtime
+
+            if r.status_code == requests.codes.requested_range_not_satisfiable:
+                # The partial file is no good. Start from scratch next time
+                print('HEY! could not resume download of {}'.format(url), file=sys.stderr)
+                os.remove(partial_file)
+                return False, last_mtime
+
+            if r.status_code not in (requests.codes.ok, requests.codes.partial_content):
+                # http request failed
+                print('HEY! get for {} returned {}'.format(url, r.status_code),
+                      file=sys.stderr)
+                return False, last_mtime
+
+            if 'Last-Modified' in r.headers:
+                mtime = httpdate_to_ts(r.headers['Last-Modified'])
+            else:
+                print('HEY! no Last-Modified header for {}'.format(url),
+                      file=sys.stderr)
+                mtime = int(time.time())
+
+            if r.status_code == requests.codes.ok and os.path.exists(local_file) and last_mtime and mtime <= int(last_mtime):
+                # The server ignored If-Modified-Since, but the file is not newer than ours: don't download it again
+                print('No need to refresh feed.', file=sys.stderr)
+                return False, last_mtime
+
+            # Remember what we are downloading, in case the download is interrupted
+            metadata['partial_etag'] = r.headers.get('ETag')
+            metadata['partial_last_modified'] = r.headers.get('Last-Modified')
+            _write_metadata(metadata_file, metadata)
+
+            if r.status_code == requests.codes.partial_content:
+                print('Resuming feed download at {} bytes..'.format(resume_from), file=sys.stderr)
+                mode = 'ab'
+            else:
+                print('Refreshing feed..', file=sys.stderr)
+                mode = 'wb'
+
+            with open(partial_file, mode) as f:
+                for chunk in r.iter_content(chunk_size=65536):
+                    f.write(chunk)
+    except requests.RequestException as e:
+        print('HEY! could not download {}: {}'.format(url, str(e)), file=sys.stderr)
         return False, last_mtime
 
-    # If file is newer than last one we saw, get it
-    updated = False
-    print('Comparing feed mtimes: feed: {} vs remote {}'.format(str(last_mtime), str(mtime)), file=sys.stderr)
-    if not last_mtime or mtime > int(last_mtime):
-        print('Refreshing feed..', file=sys.stderr)
-        updated = True
-        # download the new file content
-        conn = urllib3.connection_from_url(url)
-        r2 = conn.request(method="GET", url=url, preload_content=False) 
-        if r2.status != 200:
-            # http request failed
-            print('HEY! get for {} returned {}'.format(url, r2.status_code),
-                file=sys.stderr)
-            try:
-                r2.release_conn()
-            except Exception as e:
-                print('Could not release connection to {}: {}'.format(url, str(e)))
-            return False, last_mtime
-
-        with open(local_file,'bw') as f:
-            for chunk in r2.stream(amt=65536, decode_content=True):
-                f.write(chunk)
-
-        r2.release_conn()
-        # Change the mtime of the file
-        os.utime(local_file, (mtime, mtime))
-
-        # write new content to local file
-        print('Downloaded {}.'.format(local_file), file=sys.stderr)
-    else:   
-        print('No need to refresh feed.', file=sys.stderr)
-
-    return updated, mtime
\ No newline at end of file
+    if not _is_complete_zip(partial_file):
+        print('HEY! downloaded feed {} is not a valid zip file'.format(partial_file), file=sys.stderr)
+        os.remove(partial_file)
+        return False, last_mtime
+
+    # Change the mtime of the file, and move it into place
+    os.utime(partial_file, (mtime, mtime))
+    os.replace(partial_file, local_file)
+    _write_metadata(metadata_file, {'etag': metadata.get('partial_etag'), 
+                                    'last_modified': metadata.get('partial_last_modified')})
+
+    print('Downloaded {}.'.format(local_file), file=sys.stderr)
+    return True, mtime
@@ -0,0 +1,64 @@
+import metrics
+import sys
+import threading
+import time
+
+
+class RefreshWorker(threading.Thread):
+    """
+    Loads the timetable and refreshes the arrival times in a background thread, so that the
+    render loop never waits for the network or for pandas. The results reach the render loop
+    through the GTFSClient's update queue.
+    """
+
+    def __init__(self, create_client, interval_seconds: int) -> None:
+        """
+        create_client is called from the worker thread to build the GTFSClient, because loading
+        the feed is the slowest part of starting up.
+        """
+        super().__init__(name="refresh-worker", daemon=True)
+        self._create_client = create_client
+        self._interval_seconds = interval_seconds
+        self._cancel_event = threading.Event()
+        self._refresh_lock = threading.Lock()
+        self.client = None
+
+    def run(self) -> None:
+        while self.client is None and not self._cancel_event.is_set():
+            try:
+                self.client = self._create_client()
+            except Exception as e:
+                print("Could not load the timetable: {}".format(str(e)), file=sys.stderr)
+                self._cancel_event.wait(self._interval_seconds)
+
+        while not self._cancel_event.is_set():
+            started = time.monotonic()
+            self.refresh_now()
+            elapsed = time.monotonic() - started
+            if elapsed > self._interval_seconds:
+                print("Refresh took {:.1f}s, longer than the {}s refresh interval".format(elapsed, self._interval_seconds),
+                      file=sys.stderr)
+            self._cancel_event.wait(max(0, self._interval_seconds - elapsed))
+
+    def refresh_now(self) -> bool:
+        """
+        Refresh the arrival times, unless the timetable is still loading or a refresh is already running.
+        Returns whether a refresh was done.
+        """
+        if self.client is None:
+            return False
+        if not self._refresh_lock.acquire(blocking=False):
+            print("A refresh is already running, skipping this one", file=sys.stderr)
+            return False
+        try:
+            with metrics.timed("refresh"):
+                self.client.refresh()
+            return True
+        finally:
+            self._refresh_lock.release()
+
+    def cancel(self, timeout: float = None) -> None:
+        """ Stop refreshing, and wait up to timeout seconds for a refresh in progress to finish """
+        self._cancel_event.set()
+        if self.is_alive():
+            self.join(timeout)
@@ -0,0 +1,157 @@
+# Drawing of the arrival times on the screen
+# This is kept out of main.py because worker processes started with multiprocessing's "spawn" method
+# import the main module again: main.py must not import pygame (and numpy with it) at module level.
+from datetime import datetime
+import functools
+import pygame
+from pygame.locals import *
+from arrival_times import ArrivalTime
+from config import Config
+
+# Constants
+# The font is JD LCD Rounded by Jecko Development 
+# https://fontstruct.com/fontstructions/show/459792/jd_lcd_rounded
+TEXT_FONT = 'jd_lcd_rounded.ttf'
+LINE_COUNT = 6
+COLOR_LCD_AMBER : pygame.Color = pygame.Color(0xf4, 0xcb, 0x60)
+COLOR_LCD_GREEN: pygame.Color = pygame.Color(0xb3, 0xff, 0x00)
+COLOR_LCD_RED: pygame.Color = pygame.Color(0xff, 0x3a, 0x4a)
+
+COLOR_BACKGROUND = pygame.Color(0, 0, 0)
+TEXT_SIZE = 160  # Size of the font in pixels
+TEXT_CACHE_SIZE = 128  # How many rendered text fragments to keep
+
+# Offsets of each part within a line
+XOFFSET_ROUTE = 24
+XOFFSET_DESTINATION = 300
+XOFFSEET_TIME_LEFT = 1606
+INTER_LINE_SPACE = -15 
+
+# Some global variables
+window : pygame.Surface = None
+font: pygame.font.Font = None
+# The (text, color, x offset) fragments currently drawn on each line, so that only the lines that change are redrawn
+drawn_lines: dict[int, tuple] = {}
+
+def get_line_offset(line: int) -> int:
+    """ Calculate the Y offset within the display for a given text line """
+    global font
+    return line * (font.get_height() + INTER_LINE_SPACE)
+
+
+def get_line_rect(line: int) -> pygame.Rect:
+    """
+    Calculate the area of the display covered by a given text line. Lines are taller than the space
+    between them, so the bottom of each line overlaps the top of the next one.
+    """
+    # Rendered text can be a few pixels taller than the font's height
+    line_height = max(font.get_height(), font.get_linesize())
+    return pygame.Rect(0, get_line_offset(line), window.get_width(), line_height).clip(window.get_rect())
+
+
+@functools.lru_cache(maxsize=TEXT_CACHE_SIZE)
+def render_text(text: str, color: tuple) -> pygame.Surface:
+    """ Renders a text fragment. Rendering at this size is slow, so recently used fragments are cached. """
+    return font.render(text, True, color)
+
+
+def draw_line(line: int, fragments: tuple) -> pygame.Rect:
+    """ 
+    Draws a line made of (text, color, x offset) fragments. Returns the area of the screen that changed,
+    or None if the line already shows those fragments and does not need to be redrawn.
+    The whole area of the line is repainted, including the parts of the other lines that overlap it.
+    """
+    if drawn_lines.get(line) == fragments:
+        return None
+    drawn_lines[line] = fragments
+
+    line_rect = get_line_rect(line)
+    window.set_clip(line_rect)
+    try:
+        pygame.draw.rect(surface=window, color=COLOR_BACKGROUND, width=0, rect=line_rect)
+        for other_line in sorted(drawn_lines):
+            if get_line_rect(other_line).colliderect(line_rect):
+                for text, color, x in drawn_lines[other_line]:
+                    window.blit(render_text(text, color), dest=(x, get_line_offset(other_line)))
+    finally:
+        window.set_clip(None)
+    return line_rect
+
+
+def write_entry(line: int, 
+    route: str = '', destination: str = '', time_left: str = '', 
+    time_color: Color = COLOR_LCD_AMBER, text_color: Color = COLOR_LCD_AMBER) -> pygame.Rect:
+    """ 
+    Draws on the screen buffer an entry corresponding to an arrival time.
+    Returns the area of the screen that changed, or None if the line already showed this entry.
+    """
+    text_color = tuple(text_color)
+    return draw_line(line, ((route[0:4], text_color, XOFFSET_ROUTE),
+                            (destination[0:21], text_color, XOFFSET_DESTINATION),
+                            (time_left[0:5], tuple(time_color), XOFFSEET_TIME_LEFT)))
+
+def write_line(line: int, text: str, text_color: Color = COLOR_LCD_AMBER) -> pygame.Rect:
+    """ 
+    Draws on the screen buffer an arbitrary text.
+    Returns the area of the screen that changed, or None if the line already showed this text.
+    """
+    return draw_line(line, ((text, tuple(text_color), XOFFSET_ROUTE),))
+
+
+def update_screen(config: Config, updates: list[ArrivalTime]) -> list[pygame.Rect]:
+    """ 
+    Repaint the screen with the new arrival times. Only the lines that changed are redrawn.
+    Returns the areas of the screen that changed.
+    """
+    changed_rects = []
+    try: 
+        updates = updates[0:LINE_COUNT - 1] # take the first X lines; the last one shows the time
+        for line_num in range(LINE_COUNT - 1):
+            if line_num >= len(updates):
+                # Blank out lines that are no longer used
+                changed_rects.append(write_entry(line = line_num))
+                continue
+
+            update = updates[line_num]
+            # Read the countdown once, so the color and the text agree
+            due_in_minutes = update.due_in_minutes
+            # Find what color we need to use for the ETA
+            time_to_walk = due_in_minutes - (config.minutes_to_stop(update.stop_id) or 0)
+            lcd_color = None
+            if time_to_walk > 5:
+                lcd_color = COLOR_LCD_GREEN
+            elif time_to_walk > 1:
+                lcd_color = COLOR_LCD_AMBER
+            else:
+                lcd_color = COLOR_LCD_RED
+
+            # Draw the line
+            changed_rects.append(write_entry(
+                line = line_num,
+                route = update.route_id,
+                destination = update.destination,
+                time_left = 'Due' if due_in_minutes < 1 else update.due_in_str(),
+                time_color = lcd_color,
+                text_color = COLOR_LCD_GREEN if update.is_added else COLOR_LCD_AMBER
+            ))
+
+        # Add the current time to the bottom line
+        datetime_text = "Current time: " + datetime.today().strftime("%d/%m/%Y %H:%M")
+        changed_rects.append(write_line(LINE_COUNT - 1, datetime_text))
+    except Exception as e:
+        print("Error updating screen: ", str(e))
+
+    return [rect for rect in changed_rects if rect is not None]
+
+def clear_screen() -> None:
+    """ Clear screen """
+    pygame.draw.rect(surface=window, color=COLOR_BACKGROUND, width=0, rect=(0, 0, window.get_width(), window.get_height()))
+    drawn_lines.clear()
+
+
+def init_screen() -> pygame.Surface:
+    """ Create a Surface to draw on, with the given size, using either X11/Wayland (desktop) or directfb (no desktop) """
+    pygame.display.init()
+    window = pygame.display.set_mode((0, 0))
+    pygame.mouse.set_visible(False)
+    return window
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# Server mode: runs a single GTFSClient for the stops of all the displays configured in config.yaml,
+# so that the static feed is downloaded and GTFS-R is polled once per site instead of once per display.
+# The displays are started with "server-url" pointing to their entry in this server.
+from config import Config
+from display_server import DisplayServer
+from gtfs_client import GTFSClient
+import metrics
+from refresh_worker import RefreshWorker
+import signal
+from timetable_base import routes_for_stop
+
+DEFAULT_SERVER_PORT = 8080
+FEED_UPDATE_INTERVAL_HOURS = 12
+
+
+def union_of_displays(displays: dict[str, tuple[list[str], map]]) -> tuple[list[str], map]:
+    """
+    Returns the stop codes and routes for stops that cover all the displays.
+    A stop that shows all routes on any display must show all routes on the server.
+    """
+    stop_codes = []
+    routes_for_stops = {}
+    unrestricted_stops = set()
+    for display_stop_codes, display_routes_for_stops in displays.values():
+        for stop_code in display_stop_codes:
+            if not stop_code in stop_codes:
+                stop_codes.append(stop_code)
+            # Stop codes can be numbers or strings in config.yaml
+            routes = routes_for_stop(display_routes_for_stops, stop_code)
+            if len(routes) == 0:
+                unrestricted_stops.add(stop_code)
+            for route in sorted(routes):
+                stop_routes = routes_for_stops.setdefault(stop_code, [])
+                if not route in stop_routes:
+                    stop_routes.append(route)
+
+    for stop_code in unrestricted_stops:
+        routes_for_stops.pop(stop_code, None)
+    return stop_codes, routes_for_stops
+
+
+def main():
+    # Block the stop signals before starting any thread, so that they are all left to sigwait()
+    stop_signals = [signal.SIGINT, signal.SIGTERM]
+    signal.pthread_sigmask(signal.SIG_BLOCK, stop_signals)
+
+    config = Config()
+    metrics.start(config.metrics_port, config.metrics_file)
+    displays = config.displays()
+    stop_codes, routes_for_stops = union_of_displays(displays)
+
+    # Bind the port first, so that a port in use stops the server before the timetable is loaded
+    server = DisplayServer(displays, config.server_port or DEFAULT_SERVER_PORT)
+
+    def create_server() -> DisplayServer:
+        server.client = GTFSClient(feed_url=config.gtfs_feed_url,
+                                   gtfs_r_url=config.gtfs_api_url,
+                                   gtfs_r_api_key=config.gtfs_api_key,
+                                   stop_codes=stop_codes, 
+                                   routes_for_stops=routes_for_stops,
+                                   update_queue=None, 
+                                   update_interval_seconds=config.update_interval_seconds,
+                                   feed_update_interval_seconds=(config.feed_update_interval_hours or FEED_UPDATE_INTERVAL_HOURS) * 3600,
+                                   feed_load_workers=config.feed_load_workers,
+                                   gtfs_r_max_interval_seconds=config.gtfs_api_max_interval_seconds or 15 * 60,
+                                   gtfs_r_daily_request_budget=config.gtfs_api_daily_request_budget,
+                                   snapshot_file=config.snapshot_file,
+                                   timetable_engine=config.timetable_engine)
+        return server
+
+    worker = RefreshWorker(create_server, config.update_interval_seconds)
+    worker.start()
+    signal.sigwait(stop_signals)
+    worker.cancel(timeout=1)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
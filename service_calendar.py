@@ -0,0 +1,71 @@
+import datetime
+
+# Weekday columns of calendar.txt, in the order of datetime.date.weekday()
+WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+
+# Values of calendar_dates.txt's exception_type
+SERVICE_ADDED = 1
+SERVICE_REMOVED = 2
+
+
+def parse_gtfs_date(s: str) -> datetime.date:
+    """ Parse a GTFS date (format yyyymmdd) """
+    s = str(s)
+    return datetime.date(int(s[0:4]), int(s[4:6]), int(s[6:8]))
+
+
+class ServiceCalendar:
+    """
+    Resolves which service IDs run on each day of the feed's validity window.
+    The whole window is computed once when the feed is loaded, applying the additions and
+    removals from calendar_dates.txt, so that looking up a day is a single dictionary access.
+    """
+
+    def __init__(self, calendar_rows, calendar_date_rows) -> None:
+        """
+        calendar_rows yields (service_id, start_date, end_date, weekday flags) tuples, where the weekday flags
+        are in WEEKDAYS order. calendar_date_rows yields (service_id, date, exception_type) tuples.
+        """
+        one_day = datetime.timedelta(days=1)
+        services_by_date = {}
+
+        for service_id, start_date, end_date, weekdays in calendar_rows:
+            day = parse_gtfs_date(start_date)
+            end = parse_gtfs_date(end_date)
+            while day <= end:
+                if weekdays[day.weekday()]:
+                    services_by_date.setdefault(day, set()).add(service_id)
+                day += one_day
+
+        for service_id, date, exception_type in calendar_date_rows:
+            services = services_by_date.setdefault(parse_gtfs_date(date), set())
+            if exception_type == SERVICE_ADDED:
+                services.add(service_id)
+            elif exception_type == SERVICE_REMOVED:
+                services.discard(service_id)
+
+        # Most days share the same set of services with many others, so keep only one copy of each set
+        distinct_sets = {}
+        self._services_by_date = {}
+        for day, services in services_by_date.items():
+            services = frozenset(services)
+            self._services_by_date[day] = distinct_sets.setdefault(services, services)
+
+    @staticmethod
+    def from_frames(calendar, calendar_dates) -> "ServiceCalendar":
+        """ Build the calendar from the calendar and calendar_dates tables of a gtfs_kit feed (either can be None) """
+        calendar_rows = []
+        if calendar is not None:
+            flags = calendar[WEEKDAYS].fillna(0).astype(int).eq(1).itertuples(index=False, name=None)
+            calendar_rows = zip(calendar["service_id"], calendar["start_date"], calendar["end_date"], flags)
+
+        calendar_date_rows = []
+        if calendar_dates is not None:
+            calendar_date_rows = zip(calendar_dates["service_id"], calendar_dates["date"],
+                                     calendar_dates["exception_type"].fillna(0).astype(int))
+
+        return ServiceCalendar(calendar_rows, calendar_date_rows)
+
+    def active_service_ids(self, day: datetime.date) -> frozenset:
+        """ Returns the IDs of the services that run on the given day """
+        return self._services_by_date.get(day, frozenset())
@@ -0,0 +1,160 @@
+# Filtering of stop_times.txt by stop
+# stop_times.txt is by far the largest file of the feed, and only the rows for our stops are kept.
+# The file is read in blocks of whole lines, and each block is reduced to the lines of the wanted stops
+# by scanning its raw bytes, before anything is parsed into a DataFrame. This way most of the time
+# goes into decompressing the file, and pandas only parses a few thousand lines.
+# The blocks can be filtered in a pool of processes, so this module must stay light to import:
+# it's loaded by every worker process, along with the main module of the program (see main.py).
+
+import collections
+import concurrent.futures
+import csv
+import multiprocessing
+
+# Size of the blocks of stop_times.txt handed to the filter
+BLOCK_SIZE = 4 * 1024 * 1024
+
+# Up to this many stops, each stop ID is searched for in the block. With more, every line is split instead
+FIND_MAX_STOPS = 8
+
+# Bytes that can come right before and right after a field
+FIELD_START = frozenset(b",\n")
+FIELD_END = frozenset(b",\r\n")
+
+
+def column_index(header: bytes, column: str) -> int:
+    """ Position of a column in the header line of a CSV file """
+    columns = next(csv.reader([header.decode("utf-8-sig")]))
+    return [c.strip() for c in columns].index(column)
+
+
+def iter_blocks(f, block_size: int = BLOCK_SIZE) -> iter:
+    """ Reads a binary file in blocks of about block_size bytes that end at the end of a line """
+    remainder = b""
+    while True:
+        data = f.read(block_size)
+        if not data:
+            break
+        data = remainder + data
+        end = data.rfind(b"\n") + 1
+        if end == 0:
+            # A line longer than the block size
+            remainder = data
+            continue
+        remainder = data[end:]
+        yield data[:end]
+
+    if remainder:
+        yield remainder + b"\n"
+
+
+def filter_file(f, stop_ids: frozenset, workers: int = 1, trip_ids_by_stop: dict[str, frozenset] = None) -> bytes:
+    """
+    Returns the header line of a binary stop_times.txt file followed by the lines whose stop_id is one of stop_ids.
+    With more than one worker, the blocks are filtered by a pool of processes.
+    trip_ids_by_stop can restrict some of the stops to some trips (e.g. the trips of the routes shown at that stop).
+    """
+    header = f.readline()
+    stop_id_column = column_index(header, "stop_id")
+    kept = [header]
+    if workers <= 1:
+        for block in iter_blocks(f):
+            kept.append(filter_block(block, stop_id_column, stop_ids))
+        return filter_trips(b"".join(kept), trip_ids_by_stop)
+
+    # The workers import this module and the program's main module again, which are both kept light
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        # Bound the number of blocks in flight, so that memory use does not depend on the size of the feed
+        pending = collections.deque()
+        for block in iter_blocks(f):
+            pending.append(pool.submit(filter_block, block, stop_id_column, stop_ids))
+            if len(pending) >= workers * 2:
+                kept.append(pending.popleft().result())
+        while pending:
+            kept.append(pending.popleft().result())
+    return filter_trips(b"".join(kept), trip_ids_by_stop)
+
+
+def filter_trips(lines: bytes, trip_ids_by_stop: dict[str, frozenset]) -> bytes:
+    """
+    Takes the header line and the lines of our stops, and drops the lines whose stop is restricted to
+    some trips in trip_ids_by_stop and whose trip is not one of them.
+    By now there are only a few thousand lines left, so they are simply split (or parsed, if there are quotes)
+    """
+    if not trip_ids_by_stop:
+        return lines
+
+    header_end = lines.index(b"\n") + 1
+    header = lines[:header_end]
+    stop_id_column = column_index(header, "stop_id")
+    trip_id_column = column_index(header, "trip_id")
+    quoted = b'"' in lines
+
+    kept = [header]
+    for line in lines[header_end:].splitlines(keepends=True):
+        if quoted:
+            fields = [field.strip() for field in next(csv.reader([line.decode("utf-8")]), [])]
+        else:
+            fields = line.rstrip(b"\r\n").decode("utf-8").split(",")
+        trip_ids = trip_ids_by_stop.get(fields[stop_id_column])
+        if trip_ids is None or fields[trip_id_column] in trip_ids:
+            kept.append(line)
+    return b"".join(kept)
+
+
+def filter_block(block: bytes, stop_id_column: int, stop_ids: frozenset) -> bytes:
+    """ Returns the lines of a block of stop_times.txt whose stop_id is one of stop_ids, in their original order """
+    stop_ids = frozenset(stop_id.encode("utf-8") for stop_id in stop_ids)
+    if not b'"' in block:
+        try:
+            if len(stop_ids) <= FIND_MAX_STOPS:
+                return _find_lines(block, stop_id_column, stop_ids)
+            return _split_lines(block, stop_id_column, stop_ids)
+        except IndexError:
+            # A line with fewer fields than expected
+            pass
+    return _parse_lines(block, stop_id_column, stop_ids)
+
+
+def _find_lines(block: bytes, stop_id_column: int, stop_ids: frozenset) -> bytes:
+    """
+    Searches the block for each stop ID, and keeps the lines where it is found in the stop_id column.
+    Each search is a fast scan in C, and only the few lines found are looked at in Python.
+    """
+    starts = set()
+    for stop_id in stop_ids:
+        pos = block.find(stop_id)
+        while pos >= 0:
+            end = pos + len(stop_id)
+            # Only whole fields count: S1 must not match S10
+            if (pos == 0 or block[pos - 1] in FIELD_START) and (end == len(block) or block[end] in FIELD_END):
+                start = block.rfind(b"\n", 0, pos) + 1
+                if block.count(b",", start, pos) == stop_id_column:
+                    starts.add(start)
+            pos = block.find(stop_id, end)
+
+    kept = []
+    for start in sorted(starts):
+        kept.append(block[start:block.index(b"\n", start) + 1])
+    return b"".join(kept)
+
+
+def _split_lines(block: bytes, stop_id_column: int, stop_ids: frozenset) -> bytes:
+    """ Splits every line just up to the stop_id column, for when there are too many stops to search for """
+    # The stop_id can be the last field of the line, followed by the \r of a \r\n line ending
+    stop_ids = stop_ids | frozenset(stop_id + b"\r" for stop_id in stop_ids)
+    lines = block.split(b"\n")
+    # The block ends with a newline, which leaves an empty string at the end
+    lines.pop()
+    return b"".join([line + b"\n" for line in lines if line.split(b",", stop_id_column + 1)[stop_id_column] in stop_ids])
+
+
+def _parse_lines(block: bytes, stop_id_column: int, stop_ids: frozenset) -> bytes:
+    """ The slow path, for blocks with quoted fields: quoted fields can contain commas, so the csv module splits them """
+    kept = []
+    for line in block.splitlines(keepends=True):
+        fields = next(csv.reader([line.decode("utf-8")]), [])
+        if len(fields) > stop_id_column and fields[stop_id_column].strip().encode("utf-8") in stop_ids:
+            kept.append(line)
+    return b"".join(kept)
@@ -0,0 +1,256 @@
+import concurrent.futures
+import datetime
+from departures import ServiceDayDepartures
+import gtfs_kit as gk
+import io
+import metrics
+import os
+import pandas as pd
+from service_calendar import ServiceCalendar
+import stop_times_filter
+import sys
+from timetable_base import BaseTimetable, trip_ids_by_stop
+import zipfile
+
+# Columns of the retained tables with few distinct values, which are stored as categoricals:
+# each distinct string is kept once, and each row only holds a small integer code
+CATEGORICAL_COLUMNS = {
+    "stop_times": ["trip_id", "stop_id"],
+    "trips": ["route_id", "service_id", "trip_headsign"],
+    "routes": ["agency_id"],
+    "calendar_dates": ["service_id"],
+}
+
+class Timetable(BaseTimetable):
+    """
+    The part of the static GTFS feed that serves the configured stops, together with the lookup
+    structures needed to answer "which buses come next" without scanning any tables.
+    Once built its contents never change: a new feed is loaded into a new Timetable,
+    which then replaces the old one as a whole.
+    """
+
+    def __init__(self, feed: gk.Feed, stop_codes: list[str], routes_for_stops: dict[str, str]):
+        super().__init__(stop_codes, routes_for_stops)
+        self.feed = feed
+
+        with metrics.timed("service_calendar"):
+            self.service_calendar = ServiceCalendar.from_frames(self.feed.calendar, self.feed.calendar_dates)
+        self.stop_ids = frozenset(self.__wanted_stop_ids())
+        self.__build_lookups()
+
+    @classmethod
+    def _from_tables(cls, feed_dict: dict, stop_codes: list[str], routes_for_stops: dict[str, str]) -> "Timetable":
+        """ The tables are the ones of a gtfs_kit Feed """
+        feed_dict["dist_units"] = "km"
+
+        # Create feed
+        return cls(gk.Feed(**feed_dict), stop_codes, routes_for_stops)
+
+    @staticmethod
+    def compile_feed(path: str, stop_codes: list[str], workers: int = 1, routes_for_stops: dict = None) -> dict:
+        """
+        NOTE: This helper method was extracted from gtfs_kit.feed to modify it
+        to only load the stop_times for the stops we are interested in,
+        because loading the entire feed would use more memory than the Raspberry Pi Zero W has.
+        At the stops that only show some routes (routes_for_stops), only the stop_times of those routes are loaded.
+
+        This version also reads CSV data straight from the zip file to avoid
+        wearing out the Pi's SD card.
+
+        The tables are then pruned to the trips, routes, stops and calendars
+        that serve the configured stops, so they can be stored in a compact index.
+
+        stop_times.txt is filtered by scanning its raw bytes, and only the rows for our stops are parsed.
+        With more than one worker, the tables are read concurrently and stop_times.txt is filtered
+        by a pool of worker processes. With one, they are read one after another, which uses the least memory.
+        """
+        files_to_load = [
+            # List of feed files to load. stop_times.txt is loaded separately.
+            'trips.txt',
+            'routes.txt',
+            'calendar.txt',
+            'calendar_dates.txt',
+            'stops.txt',
+            'agency.txt'
+        ]
+
+        if not os.path.exists(path):
+            raise ValueError("Path {} does not exist".format(path))
+
+        print("Loading GTFS feed {}".format(path), file=sys.stderr)
+
+        feed_dict = {table: None for table in gk.cs.GTFS_REF["table"]}
+        if workers > 1:
+            # Decompressing and parsing release the GIL for most of the time, so threads are enough here
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+                tables = {filename.split(".")[0]: pool.submit(Timetable.__read_table, path, filename) 
+                          for filename in files_to_load}
+                feed_dict.update({table: future.result() for table, future in tables.items()})
+        else:
+            for filename in files_to_load:
+                feed_dict[filename.split(".")[0]] = Timetable.__read_table(path, filename)
+
+        # Finally, load stop_times.txt
+        # Obtain the list of IDs of the desired stops. This is similar to what __wanted_stop_ids() does,
+        # but without a dependency on a fully formed feed object
+        stops = feed_dict.get("stops")
+        stops = stops[stops["stop_code"].isin(stop_codes)]
+        wanted_stop_ids = stops["stop_id"]
+        # And the trips that may be shown at the stops that only show some routes
+        trips, routes = feed_dict.get("trips"), feed_dict.get("routes")
+        trip_ids_for_stops = trip_ids_by_stop(dict(zip(stops["stop_id"], stops["stop_code"])),
+                                              dict(zip(routes["route_id"], routes["route_short_name"])),
+                                              zip(trips["trip_id"], trips["route_id"]), routes_for_stops or {})
+        with zipfile.ZipFile(path) as z:
+            with z.open("stop_times.txt") as f, metrics.timed("read_feed_table", table="stop_times"):
+                # Only the lines of the wanted stops and routes are parsed
+                lines = stop_times_filter.filter_file(f, frozenset(wanted_stop_ids), workers, trip_ids_for_stops)
+                df = pd.read_csv(io.BytesIO(lines), dtype=gk.cs.DTYPE, encoding="utf-8-sig")
+                del lines
+
+            if not df.empty:
+                # Convert arrival and departure times to seconds since the start of the service day,
+                # so that comparisons and sorting are integer operations
+                arrival_seconds = Timetable.__times_to_seconds(df["arrival_time"])
+                departure_seconds = Timetable.__times_to_seconds(df["departure_time"])
+                # Either time may be left empty for stops that are not timepoints
+                arrival_seconds = arrival_seconds.fillna(departure_seconds)
+                departure_seconds = departure_seconds.fillna(arrival_seconds)
+                df = df[arrival_seconds.notna()].copy()
+                df["arrival_time"] = arrival_seconds.dropna().astype("int32")
+                df["departure_time"] = departure_seconds.dropna().astype("int32")
+                del arrival_seconds, departure_seconds
+                # Sort by arrival time once, so that each service day's departures come out sorted
+                df = df.sort_values("arrival_time", kind="stable").reset_index(drop=True)
+                feed_dict["stop_times"] = gk.cn.clean_column_names(df)
+
+        return Timetable.__compact_tables(Timetable.__prune_tables(feed_dict))
+
+
+    @staticmethod
+    def __read_table(path: str, filename: str) -> pd.DataFrame:
+        """ Read one of the tables of the feed. Returns None if it's empty """
+        table = filename.split(".")[0]
+        with zipfile.ZipFile(path) as z, z.open(filename) as f, metrics.timed("read_feed_table", table=table):
+            df = pd.read_csv(f, dtype=gk.cs.DTYPE, encoding="utf-8-sig")
+            return None if df.empty else gk.cn.clean_column_names(df)
+
+
+    @staticmethod
+    def __times_to_seconds(times: pd.core.series.Series) -> pd.core.series.Series:
+        """
+        Vectorized conversion of GTFS HH:MM:SS times into seconds since the start of the service day.
+        Hours can be 24 or more for trips that run past midnight. Empty or malformed times become NaN.
+        """
+        parts = times.str.extract(r"^\s*(\d+):(\d{2}):(\d{2})\s*$").astype("float64")
+        return parts[0] * 3600 + parts[1] * 60 + parts[2]
+
+
+    @staticmethod
+    def __prune_tables(feed_dict: dict) -> dict:
+        """
+        Drop all the rows that are not reachable from the filtered stop_times:
+        only the trips that call at our stops, and their routes and calendars, are kept.
+        """
+        stop_times = feed_dict.get("stop_times")
+        if stop_times is None:
+            return feed_dict
+
+        stops = feed_dict["stops"]
+        feed_dict["stops"] = stops[stops["stop_id"].isin(stop_times["stop_id"])].reset_index(drop=True)
+
+        trips = feed_dict["trips"]
+        trips = trips[trips["trip_id"].isin(stop_times["trip_id"])].reset_index(drop=True)
+        feed_dict["trips"] = trips
+
+        routes = feed_dict["routes"]
+        feed_dict["routes"] = routes[routes["route_id"].isin(trips["route_id"])].reset_index(drop=True)
+
+        for table in ["calendar", "calendar_dates"]:
+            df = feed_dict.get(table)
+            if df is not None:
+                feed_dict[table] = df[df["service_id"].isin(trips["service_id"])].reset_index(drop=True)
+
+        return feed_dict
+
+
+    @staticmethod
+    def __compact_tables(feed_dict: dict) -> dict:
+        """
+        Store repeated strings as categoricals and integers in the smallest type that holds them,
+        so that the timetable index and the tables kept in memory are as small as possible
+        """
+        for table, df in feed_dict.items():
+            if not isinstance(df, pd.DataFrame):
+                continue
+            for column in CATEGORICAL_COLUMNS.get(table, []):
+                if column in df.columns:
+                    df[column] = df[column].astype("category")
+            for column in df.columns:
+                if pd.api.types.is_integer_dtype(df[column]) and not isinstance(df[column].dtype, pd.CategoricalDtype):
+                    nullable = pd.api.types.is_extension_array_dtype(df[column])
+                    df[column] = pd.to_numeric(df[column], downcast="integer")
+                    if nullable:
+                        # Keep missing values (e.g. an empty direction_id) as <NA>
+                        df[column] = df[column].astype(df[column].dtype.name.capitalize())
+        return feed_dict
+
+
+    def __wanted_stop_ids(self) -> pd.core.frame.DataFrame:
+        """
+        Return a DataFrame with the ID and names of the chosen stop(s) as requested in station_names
+        """
+        stops = self.feed.stops[self.feed.stops["stop_code"].isin(self.stop_codes)]
+        if stops.empty:
+            raise Exception("Stops is empty!")
+        return stops["stop_id"]
+
+
+    def __trip_ids_for_service_ids(self, service_ids: frozenset) -> pd.core.series.Series:
+        """
+        Returns a dataframe with the trip IDs for the given service IDs
+        """
+        trips = self.feed.trips[self.feed.trips["service_id"].isin(service_ids)]
+        if trips.empty:
+            print("There are no active trips!")
+
+        return trips["trip_id"]
+
+
+    def _departures_for_day(self, day: datetime.date) -> ServiceDayDepartures:
+        with metrics.timed("active_service_ids"):
+            service_ids = self.service_calendar.active_service_ids(day)
+        trip_ids = self.__trip_ids_for_service_ids(service_ids)
+        # stop_times is already sorted by arrival time
+        stop_times = self.feed.stop_times
+        stop_times = stop_times[stop_times["trip_id"].isin(trip_ids) & stop_times["stop_id"].isin(self.stop_ids)]
+        return ServiceDayDepartures(stop_times["arrival_time"], stop_times["trip_id"], stop_times["stop_id"])
+
+
+    def __build_lookups(self) -> None:
+        """
+        Denormalize the trip, route and stop information needed to display a departure into dictionaries,
+        so that refreshing the display is a matter of dictionary lookups instead of joining DataFrames
+        """
+        routes = self.feed.routes
+        self.route_names = dict(zip(routes["route_id"], routes["route_short_name"]))
+
+        # trip_id -> (route_short_name, trip_headsign, direction_id)
+        trips = self.feed.trips
+        self.trip_info = {}
+        # (route_id, direction_id) -> trip_headsign, used for trips added by GTFS-R
+        self.headsign_by_route_direction = {}
+        for trip_id, route_id, headsign, direction_id in zip(trips["trip_id"], trips["route_id"],
+                                                             trips["trip_headsign"], trips["direction_id"]):
+            direction_id = None if pd.isna(direction_id) else int(direction_id)
+            # A missing headsign is shown as an empty destination
+            headsign = headsign if isinstance(headsign, str) else ""
+            self.trip_info[trip_id] = (self.route_names.get(route_id), headsign, direction_id)
+            if headsign:
+                self.headsign_by_route_direction.setdefault((route_id, direction_id), headsign)
+
+        # The trips that call at our stops. GTFS-R updates for any other trip are ignored
+        self.relevant_trip_ids = frozenset(self.trip_info.keys())
+
+        stops = self.feed.stops
+        self.stop_code_by_id = dict(zip(stops["stop_id"], stops["stop_code"]))
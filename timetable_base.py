@@ -0,0 +1,210 @@
+# Queries shared by the timetable engines
+# The timetable can be built with pandas (timetable.py) or with plain Python containers (lite_timetable.py).
+# Both end up with the same lookup dictionaries and the same per-day departure lists, and answer
+# "which buses come next" with the code below. They also load and compile their timetable index the same way.
+# This module must not import pandas.
+
+import datetime
+from departures import ServiceDayDepartures
+import heapq
+import itertools
+import metrics
+import sys
+import timetable_index
+
+
+def routes_for_stop(routes_for_stops: dict, stop_code: str) -> frozenset:
+    """
+    The routes to show at a stop, from the routes_for_stops of the configuration (keyed by the stop code,
+    usually as a number). Returns an empty set if all the routes are shown.
+    """
+    routes = routes_for_stops.get(int(stop_code)) if stop_code.isdigit() else None
+    if routes is None:
+        routes = routes_for_stops.get(stop_code)
+    return frozenset(str(route) for route in routes or [])
+
+
+def trip_ids_by_stop(stop_code_by_id: dict[str, str], route_names: dict[str, str], trip_routes,
+                     routes_for_stops: dict) -> dict[str, frozenset]:
+    """
+    Resolves routes_for_stops into the trips that may be shown at each stop, when the feed is loaded.
+    trip_routes yields (trip_id, route_id) for the trips of the feed. Only the stops that show some of
+    their routes are in the result: the others show all their trips.
+    """
+    route_ids_by_stop = {}
+    for stop_id, stop_code in stop_code_by_id.items():
+        routes = routes_for_stop(routes_for_stops, stop_code)
+        if routes:
+            route_ids_by_stop[stop_id] = frozenset(route_id for route_id, name in route_names.items() if name in routes)
+    if not route_ids_by_stop:
+        return {}
+
+    wanted_route_ids = frozenset().union(*route_ids_by_stop.values())
+    trip_ids_by_route = {}
+    for trip_id, route_id in trip_routes:
+        if route_id in wanted_route_ids:
+            trip_ids_by_route.setdefault(route_id, []).append(trip_id)
+
+    return {stop_id: frozenset(itertools.chain.from_iterable(trip_ids_by_route.get(route_id, []) for route_id in route_ids))
+            for stop_id, route_ids in route_ids_by_stop.items()}
+
+
+class BaseTimetable:
+    """
+    The queries of a timetable. Subclasses load the feed, then set the lookups:
+      - stop_ids: the IDs of the configured stops
+      - route_names: route_id -> route_short_name
+      - trip_info: trip_id -> (route_short_name, trip_headsign, direction_id)
+      - headsign_by_route_direction: (route_id, direction_id) -> trip_headsign, for trips added by GTFS-R
+      - relevant_trip_ids: the trips that call at our stops
+      - stop_code_by_id: stop_id -> stop_code
+    and implement _departures_for_day(). They also implement compile_feed(), which reads the tables that
+    serve the configured stops from the GTFS zip file, and are built from those tables by _from_tables().
+    """
+
+    # The compiled index of each engine has its own suffix, so switching engines does not throw away the other one
+    INDEX_SUFFIX = ".idx"
+
+    def __init__(self, stop_codes: list[str], routes_for_stops: dict[str, str]) -> None:
+        self.stop_codes = stop_codes
+        self.routes_for_stops = routes_for_stops
+        self.departures_by_day = {}
+
+    @staticmethod
+    def compile_feed(path: str, stop_codes: list[str], workers: int = 1, routes_for_stops: dict = None) -> dict:
+        """ Reads the tables of the feed that serve the configured stops, using the given number of worker processes """
+        raise NotImplementedError()
+
+    @classmethod
+    def _from_tables(cls, tables: dict, stop_codes: list[str], routes_for_stops: dict[str, str]) -> "BaseTimetable":
+        """ Builds the timetable from the tables returned by compile_feed() """
+        return cls(tables, stop_codes, routes_for_stops)
+
+    @classmethod
+    def load(cls, path: str, feed_mtime: int, stop_codes: list[str], routes_for_stops: dict[str, str],
+             allow_compile: bool = True, workers: int = 1) -> "BaseTimetable":
+        """
+        Load the timetable from the compiled timetable index if it is up to date,
+        otherwise compile the index from the GTFS zip file first, using the given number of worker processes.
+        Returns None if the index is not up to date and allow_compile is False.
+        """
+        index_path = timetable_index.index_path_for(path, cls.INDEX_SUFFIX)
+        with metrics.timed("load_index"):
+            tables = timetable_index.load_index(index_path, feed_mtime, stop_codes, routes_for_stops)
+        if tables is None:
+            if not allow_compile:
+                return None
+            tables = cls.compile_feed(path, stop_codes, workers, routes_for_stops)
+            timetable_index.save_index(index_path, feed_mtime, stop_codes, tables, routes_for_stops)
+        else:
+            print("Loaded timetable index {}".format(index_path), file=sys.stderr)
+
+        return cls._from_tables(tables, stop_codes, routes_for_stops)
+
+    @classmethod
+    def compile_index(cls, path: str, feed_mtime: int, stop_codes: list[str], workers: int = 1,
+                      routes_for_stops: dict = None) -> None:
+        """
+        Compile the timetable index of a feed file. This is meant to run in a separate process,
+        so that the memory needed to parse the feed is given back to the OS when it finishes.
+        """
+        tables = cls.compile_feed(path, stop_codes, workers, routes_for_stops)
+        timetable_index.save_index(timetable_index.index_path_for(path, cls.INDEX_SUFFIX), feed_mtime, stop_codes,
+                                   tables, routes_for_stops)
+
+    def _departures_for_day(self, day: datetime.date) -> ServiceDayDepartures:
+        """ Builds the departures at our stops for the service day that starts on the given date """
+        raise NotImplementedError()
+
+
+    def __departures_on(self, day: datetime.date) -> ServiceDayDepartures:
+        """
+        Returns the departures at our stops for the service day that starts on the given date.
+        They are computed the first time a day is needed and then reused.
+        """
+        departures = self.departures_by_day.get(day)
+        if departures is None:
+            departures = self._departures_for_day(day)
+            self.departures_by_day[day] = departures
+
+        return departures
+
+
+    def __route_filter(self, routes_for_stops: dict):
+        """
+        Returns a function that tells whether a departure (trip_id, stop_id) is of one of the routes
+        we are interested in at its stop (this is to eliminate routes that stop in more than one of our stops),
+        or None if all the routes are shown at every stop.
+        """
+        routes_by_stop_id = {}
+        for stop_id, stop_code in self.stop_code_by_id.items():
+            routes = routes_for_stop(routes_for_stops, stop_code)
+            if routes:
+                routes_by_stop_id[stop_id] = routes
+        if not routes_by_stop_id:
+            return None
+
+        trip_info = self.trip_info
+        def is_wanted(trip_id: str, stop_id: str) -> bool:
+            routes = routes_by_stop_id.get(stop_id)
+            return routes is None or trip_info[trip_id][0] in routes
+        return is_wanted
+
+
+    def lookup_headsign_by_route(self, route_id: str, direction_id: int) -> str:
+        """
+        Look up a destination string in Trips from the route and direction
+        """
+        destination = self.headsign_by_route_direction.get((route_id, direction_id))
+        if destination is None:
+            sys.stderr.write("Destination not found for route " + str(route_id) + ", direction " + str(direction_id) + "\n")
+            destination = "---- ?????? ----"
+
+        return destination
+
+
+    def stop_ids_for_codes(self, stop_codes: list[str]) -> frozenset:
+        """
+        Returns the IDs of the stops with the given codes
+        """
+        stop_codes = set(str(stop_code) for stop_code in stop_codes)
+        return frozenset(stop_id for stop_id, stop_code in self.stop_code_by_id.items() if stop_code in stop_codes)
+
+
+    def next_departures(self, now: datetime.datetime, num_entries: int, stop_ids: frozenset = None,
+                        routes_for_stops: dict[str, str] = None) -> list[tuple[int, str, str]]:
+        """
+        Returns the next N buses arriving at the requested stops after the given time, as
+        (arrival_time, trip_id, stop_id) tuples sorted by arrival time.
+        Arrival times are in seconds since the midnight of the given time's day.
+        stop_ids and routes_for_stops can narrow the query down to some of the stops and routes
+        (e.g. the ones of one display), otherwise all the stops and routes of this timetable are used.
+        The timetable's own routes_for_stops were applied when the feed was loaded, so other routes_for_stops
+        can only narrow them down further.
+        """
+        # Only departures of the wanted routes were loaded. Narrower routes are filtered while looking for
+        # the next departures, so that there are still num_entries of them
+        is_wanted = None
+        if routes_for_stops is not None and routes_for_stops != self.routes_for_stops:
+            is_wanted = self.__route_filter(routes_for_stops)
+
+        today = now.date()
+        seconds_now = now.hour * 3600 + now.minute * 60 + now.second
+
+        # Trips of yesterday's service day can run past midnight, and near midnight the next
+        # buses can be part of tomorrow's service day. Take the next N of each day, with times
+        # relative to today's midnight, and merge them.
+        next_by_day = []
+        for day_offset in [-1, 0, 1]:
+            offset_seconds = day_offset * 86400
+            departures = self.__departures_on(today + datetime.timedelta(days=day_offset))
+            next_by_day.append([(arrival_time + offset_seconds, trip_id, stop_id)
+                                for arrival_time, trip_id, stop_id
+                                in departures.next_departures(seconds_now - offset_seconds, num_entries, stop_ids, is_wanted)])
+
+        # Forget the days that can no longer be queried
+        for day in list(self.departures_by_day.keys()):
+            if abs((day - today).days) > 1:
+                del self.departures_by_day[day]
+
+        return list(itertools.islice(heapq.merge(*next_by_day, key=lambda departure: departure[0]), num_entries))
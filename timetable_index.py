@@ -0,0 +1,83 @@
+# Compiled per-stop timetable index
+# Parsing the whole GTFS zip takes minutes on a Raspberry Pi Zero W, but only a tiny part of it
+# is relevant to the stops we display. The relevant tables are compiled once into a small file,
+# and later boots load that file in one bulk read instead of parsing the zip.
+# The index is rebuilt whenever the feed's Last-Modified time or the configured stops and routes change.
+# The index is a pickle, and loading a pickle can run code, so it is kept in a private cache directory
+# (~/.cache/dublinbus) rather than next to the feed in /tmp, where any local user could plant one.
+
+import atomic_file
+import os
+import pickle
+import stat
+import sys
+
+# Bump this whenever the layout of the compiled tables changes
+INDEX_VERSION = 5
+
+
+def index_dir() -> str:
+    """ Returns the directory where the compiled indexes are kept """
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "dublinbus")
+
+
+def index_path_for(feed_path: str, suffix: str = ".idx") -> str:
+    """ Returns the path of the compiled index that belongs to a feed file. Each timetable engine uses its own suffix """
+    return os.path.join(index_dir(), os.path.splitext(os.path.basename(feed_path))[0] + suffix)
+
+
+def _is_private_dir(path: str) -> bool:
+    """ Tells whether a directory belongs to us and nobody else can write to it """
+    st = os.lstat(path)
+    return stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+
+def _index_header(feed_mtime: int, stop_codes: list[str], routes_for_stops: dict) -> dict:
+    return {
+        "version": INDEX_VERSION,
+        "feed_mtime": int(feed_mtime),
+        "stop_codes": sorted(str(s) for s in stop_codes),
+        # Only the departures of these routes are compiled at their stops
+        "routes_for_stops": sorted((str(stop_code), sorted(str(route) for route in routes))
+                                   for stop_code, routes in (routes_for_stops or {}).items() if routes),
+    }
+
+
+def load_index(index_path: str, feed_mtime: int, stop_codes: list[str], routes_for_stops: dict = None) -> dict:
+    """
+    Returns the tables stored in the compiled index, or None if there is no index
+    or it was compiled from a different feed or set of stops and routes.
+    """
+    try:
+        if not _is_private_dir(os.path.dirname(index_path)):
+            print("Not loading timetable index {}: its directory can be written by other users".format(index_path),
+                  file=sys.stderr)
+            return None
+        with open(index_path, "rb") as f:
+            # The header is pickled separately so a stale index is rejected without loading the tables
+            header = pickle.load(f)
+            if header != _index_header(feed_mtime, stop_codes, routes_for_stops):
+                print("Timetable index {} is out of date".format(index_path), file=sys.stderr)
+                return None
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print("Could not read timetable index {}: {}".format(index_path, str(e)), file=sys.stderr)
+        return None
+
+
+def save_index(index_path: str, feed_mtime: int, stop_codes: list[str], tables: dict, routes_for_stops: dict = None) -> None:
+    """
+    Writes the compiled tables to disk. The file is written under a temporary name and renamed
+    into place, so an interrupted write never leaves a corrupt index behind.
+    """
+    try:
+        os.makedirs(os.path.dirname(index_path), mode=0o700, exist_ok=True)
+        with atomic_file.replace_file(index_path, "wb", permissions=0o600) as f:
+            pickle.dump(_index_header(feed_mtime, stop_codes, routes_for_stops), f, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(tables, f, protocol=pickle.HIGHEST_PROTOCOL)
+        print("Wrote timetable index {}".format(index_path), file=sys.stderr)
+    except Exception as e:
+        print("Could not write timetable index {}: {}".format(index_path, str(e)), file=sys.stderr)